@@ -1,13 +1,16 @@
 import numpy as np
 import random
-import matplotlib.pyplot as plt
-import pandas as pd
 import os
-import csv
+import sys
 import time
 import math
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
+import json
+import shutil
+import hashlib
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import VL_result_store
 
 # Define model parameters
 num_agents = 1000  # Number of agents in the simulation
@@ -30,8 +33,20 @@ death_rates = [0.007, 0.007, 0.007, 0.007, 0.007, 0.007, 0.007]
 # Define the immunosenescence factor for each age group
 immunosenescence_factors = [0.95, 0.7, 0.6, 0.3, 0.3, 0.2, 0.15]
 
-# Create a list to store the areas under the viral load curves for each age group
-viral_load_areas = []
+# Number of random contacts per agent per time step (200 contacts per step for 1000 agents)
+contacts_per_agent = 0.2
+
+# Trajectory recording: dtype of the per-agent viral load buffer (np.float32 halves its memory), record every
+# k-th time step, and the age groups to record (None records all of them)
+trajectory_dtype = np.float64
+record_every = 1
+record_age_groups = None
+# Keep per-agent viral load trajectories and histories in compact results. Without them a compact result still has
+# the tallies and the per-agent infection kinetics table, whose auc column is the area under each agent's curve.
+record_trajectories = True
+# Add a log of every state transition and the deaths by age group to compact results (see EventLog). With
+# record_trajectories off this is the sparse output mode; replay_state_dynamics() rebuilds the state tallies from it.
+record_events = False
 
 # Viral load thresholds to determine when agents change compartments
 thresh1 = 0.05
@@ -39,15 +54,133 @@ thresh2 = 0.5
 thresh3 = 1.0
 thresh4 = 0.2
 
-
-# Create primary for ABM model results
+# Social interaction matrix based on age group (row: age group of agent 1, column: age group of agent 2)
+social_interaction_matrix = np.array([
+    [2.5982, 0.8003, 0.3160, 0.7934, 0.3557, 0.1548, 0.0564],
+    [0.6473, 4.1960, 0.6603, 0.5901, 0.4665, 0.1238, 0.0515],
+    [0.1737, 1.7500, 11.1061, 0.9782, 0.7263, 0.0815, 0.0273],
+    [0.5504, 0.5906, 1.2004, 1.8813, 0.9165, 0.1370, 0.0397],
+    [0.3894, 0.7848, 1.3139, 1.1414, 1.3347, 0.2260, 0.0692],
+    [0.3610, 0.3918, 0.3738, 0.5248, 0.5140, 0.7072, 0.1469],
+    [0.1588, 0.3367, 0.3406, 0.2286, 0.3637, 0.3392, 0.3868]
+])
+
+# Print a per-simulation report (people and deaths by age group, maximum viral loads)
+verbose = True
+
+# Time each phase of a simulation step (see PhaseProfiler), optionally also counting allocated memory blocks
+profile = False
+profile_allocations = False
+
+# Stop simulating once the epidemic is over and fill in the remaining time steps directly
+stop_at_extinction = True
+
+# Largest number of replicates the batched engine advances together in one call
+replicates_per_batch = 64
+
+# Build the initial population once from this seed and reuse it for every replicate (None draws a new population
+# for each replicate). With rejitter_population the reused population gets new compartment thresholds each time.
+population_seed = None
+rejitter_population = False
+# Number of populations each process keeps in its population cache
+population_cache_size = 8
+
+# Seconds between checkpoints of an ensemble run with a checkpoint path
+checkpoint_interval = 300.0
+
+# Worker processes write their results into a ResultArena instead of sending them back pickled. Unless a run is
+# given an arena directory, the arena is a temporary directory under arena_root (None is the system temporary
+# directory; '/dev/shm' keeps it in shared memory, if the arena fits there). The arena holds the per-step tallies,
+# 23 kB per replicate of 60 time steps whatever the number of agents. With arena_per_agent it also holds the
+# per-agent arrays, trajectories and histories, up to about num_agents * time_steps * 16 bytes per replicate.
+use_result_arena = True
+arena_root = None
+arena_per_agent = False
+
+# Integer codes for the agent states used by the vectorized engine, in the column order of state_counts
+state_names = ['S', 'E', 'I', 'R', 'D']
+S_STATE, E_STATE, I_STATE, R_STATE, D_STATE = range(len(state_names))
+state_codes = {name: code for code, name in enumerate(state_names)}
+
+# Directory for the ABM model results, created by run_ensemble() and plot() when they write to it
 primary_directory = "Primary ABM Model Directory"
-if not os.path.exists(primary_directory):
-    os.mkdir(primary_directory)
 
-# Define agent class
+
+# Model parameters of one run. Every parameter defaults to the module-level value above, so
+# SimulationConfig(num_agents=5000, time_steps=120) only changes what is passed in.
+class SimulationConfig:
+    parameter_names = ['num_agents', 'num_exposed', 'num_infected', 'num_recovered', 'latent_period', 'time_steps',
+                       'immune_period', 'age_groups', 'age_probs', 'death_rates', 'immunosenescence_factors',
+                       'contacts_per_agent', 'thresh1', 'thresh2', 'thresh3', 'thresh4', 'social_interaction_matrix',
+                       'trajectory_dtype', 'record_every', 'record_age_groups', 'record_trajectories', 'record_events',
+                       'verbose', 'profile', 'profile_allocations', 'stop_at_extinction', 'population_seed',
+                       'rejitter_population']
+    # Parameters that only change what is printed or profiled, not the results
+    output_parameter_names = ['verbose', 'profile', 'profile_allocations']
+
+    def __init__(self, **parameters):
+        unknown = sorted(set(parameters) - set(self.parameter_names))
+        if unknown:
+            raise TypeError(f"Unknown simulation parameters: {', '.join(unknown)}")
+        module_parameters = globals()
+        for name in self.parameter_names:
+            setattr(self, name, parameters.get(name, module_parameters[name]))
+        self.social_interaction_matrix = np.asarray(self.social_interaction_matrix, dtype=float)
+
+    def replace(self, **parameters):
+        # Copy of this configuration with some parameters changed
+        current = {name: getattr(self, name) for name in self.parameter_names}
+        current.update(parameters)
+        return SimulationConfig(**current)
+
+    def content_hash(self, names=None):
+        # SHA-256 of the given parameters (all of them by default), the same in every process and session
+        values = {name: getattr(self, name) for name in (self.parameter_names if names is None else names)}
+        return hashlib.sha256(json.dumps(values, sort_keys=True, default=canonical_parameter).encode()).hexdigest()
+
+    def result_hash(self):
+        # content_hash of the parameters that change the results
+        return self.content_hash([name for name in self.parameter_names if name not in self.output_parameter_names])
+
+
+def canonical_parameter(value):
+    # JSON form of the parameter values json cannot write itself: arrays, NumPy scalars and dtypes
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return np.dtype(value).str
+
+
+def resolve_config(config):
+    return SimulationConfig() if config is None else config
+
+
+@functools.lru_cache(maxsize=None)
+def age_group_bounds(age_groups):
+    # (lowest age, highest age) of each age group, parsed once per tuple of age group names like '5-14'
+    return np.array([[int(bound) for bound in age_group.split('-')] for age_group in age_groups])
+
+
+@functools.lru_cache(maxsize=None)
+def age_group_lookup(age_groups):
+    # Age group index of every age; an age in several groups gets the last one, as in the original loop
+    return {age: index for index, (lowest, highest) in enumerate(age_group_bounds(age_groups))
+            for age in range(lowest, highest + 1)}
+
+
+def jittered_thresholds(config, rng, num_agents):
+    # Compartment thresholds 1-4 of each agent, shape (4, num_agents), each within 18.75 % of its configured value
+    thresholds = np.array([config.thresh1, config.thresh2, config.thresh3, config.thresh4])[:, np.newaxis]
+    return thresholds + (rng.random((4, num_agents)) - 0.5) * thresholds * 0.375
+
+
+# Define agent class. The age group and the jittered thresholds can be passed in when they are already known,
+# e.g. from a Population.
 class Agent:
-    def __init__(self, state, viralload, age):
+    def __init__(self, state, viralload, age, config=None, age_group_index=None, thresholds=None):
+        config = resolve_config(config)
+        self.config = config
         self.state = state
         self.days_exposed = 0
         self.days_infected = 0
@@ -55,19 +188,19 @@ class Agent:
         self.immune_days = 0
         self.age = age
         self.is_dead = False
-        self.age_group_index = None
-        for index, age_group in enumerate(age_groups):
-            age_range = age_group.split('-')
-            if int(age_range[0]) <= self.age <= int(age_range[1]):
-                self.age_group_index = index
-        self.immunosenescence_factor = immunosenescence_factors[self.age_group_index]
-        self.threshold1 = thresh1 + ((random.random() - 0.5) * thresh1 * 0.375)
-        self.threshold2 = thresh2 + ((random.random() - 0.5) * thresh2 * 0.375)
-        self.threshold3 = thresh3 + ((random.random() - 0.5) * thresh3 * 0.375)
-        self.threshold4 = thresh4 + ((random.random() - 0.5) * thresh4 * 0.375)
+        if age_group_index is None:
+            age_group_index = age_group_lookup(tuple(config.age_groups)).get(age)
+        self.age_group_index = age_group_index
+        self.immunosenescence_factor = config.immunosenescence_factors[self.age_group_index]
+        if thresholds is None:
+            thresholds = [threshold + ((random.random() - 0.5) * threshold * 0.375)
+                          for threshold in (config.thresh1, config.thresh2, config.thresh3, config.thresh4)]
+        self.threshold1, self.threshold2, self.threshold3, self.threshold4 = thresholds
         self.viral_load_history = []
         self.falling_viral_load = False
-    def update_state(self, deaths_by_ages):
+    # uniform returns the next uniform(0, 1) draw: random.random by default, or the next of the draws simulate() makes
+    # in bulk for each time step
+    def update_state(self, deaths_by_ages, uniform=random.random):
         if self.state == 'S':
             self.days_infected = 0
             self.days_exposed = 0
@@ -79,25 +212,25 @@ class Agent:
                 self.days_exposed = 0
         elif self.state == 'E':
             self.days_exposed += 1
-            self.viralload += random.random() / 5
-            if self.days_exposed < latent_period and self.viralload > self.threshold2:
+            self.viralload += uniform() / 5
+            if self.days_exposed < self.config.latent_period and self.viralload > self.threshold2:
                 self.state = 'I'
                 self.days_infected = 0
-            elif self.days_exposed >= latent_period:
+            elif self.days_exposed >= self.config.latent_period:
                 self.state = 'R'
 
         elif self.state == 'I':
             self.days_infected += 1
             if self.falling_viral_load == False:
-                self.viralload += random.random() / 3  # Increasing viral load
+                self.viralload += uniform() / 3  # Increasing viral load
                 if self.viralload > self.threshold3:
                     self.falling_viral_load = True
             else:
-                self.viralload -= random.random() * (self.immunosenescence_factor) # Decreasing viral load
+                self.viralload -= uniform() * (self.immunosenescence_factor) # Decreasing viral load
 
             self.viralload = max(self.viralload, 0)  # Prevent viral load from going below zero
             # Check if agent should die based on age and death rate
-            if random.random() < death_rates[self.age_group_index]:
+            if uniform() < self.config.death_rates[self.age_group_index]:
                 self.is_dead = True
 
             if self.is_dead:
@@ -111,7 +244,7 @@ class Agent:
              self.viralload = 0
         elif self.state == 'R':
             if self.viralload > 0:
-                self.viralload -= (random.random() * self.immunosenescence_factor)/3
+                self.viralload -= (uniform() * self.immunosenescence_factor)/3
                 self.viralload = max(self.viralload, 0)
             # Adds reinfectivity
             # if self.immune_days >= immune_period:  # Check if the agent's immunity period is over
@@ -120,8 +253,9 @@ class Agent:
             #     self.immune_days = 0    # Reset the immune days counter
             # else:
             #     self.immune_days += 1
-            # Append the viral load to the history if it's nonzero
-        if self.viralload > 0:
+            # Append the viral load to the history if it's nonzero (agents of a compact run have no history list,
+            # the engine keeps their histories in one buffer)
+        if self.viralload > 0 and self.viral_load_history is not None:
             self.viral_load_history.append(self.viralload)
 
     def get_state(self):
@@ -133,195 +267,727 @@ class Agent:
         self.is_dead = True
 
 
+# Initial agent arrays of a synthetic population, built with bulk draws: the age group, age, state and viral load
+# of every agent and its jittered compartment thresholds. With num_replicates > 1 the arrays hold that many copies
+# of the population back to back, as in AgentArrays, each with its own ages and thresholds.
+class Population:
+    # Parameters that determine a population. With population_seed they are the key of the population cache.
+    parameter_names = ['num_agents', 'num_exposed', 'num_infected', 'num_recovered', 'age_groups', 'age_probs',
+                       'death_rates', 'immunosenescence_factors', 'thresh1', 'thresh2', 'thresh3', 'thresh4']
+
+    def __init__(self, config, rng, num_replicates=1):
+        num_agents = config.num_agents
+        self.num_replicates = num_replicates
+        agents_per_age_group, age_group_index, initial_state, initial_viralload = population_layout(config)
+        self.agents_per_age_group = agents_per_age_group
+        self.age_group_index = np.tile(age_group_index, num_replicates)
+        age_bounds = age_group_bounds(tuple(config.age_groups))
+        self.age = rng.integers(age_bounds[self.age_group_index, 0], age_bounds[self.age_group_index, 1] + 1)
+        self.state = np.tile(initial_state, num_replicates)
+        self.viralload = np.tile(initial_viralload, num_replicates)
+
+        self.immunosenescence_factor = np.array(config.immunosenescence_factors)[self.age_group_index]
+        self.death_rate = np.array(config.death_rates)[self.age_group_index]
+        self.thresholds = jittered_thresholds(config, rng, num_agents * num_replicates)
+
+    def tile(self, num_replicates):
+        # num_replicates copies of this population, in new arrays that the engines can update in place
+        population = Population.__new__(Population)
+        population.num_replicates = self.num_replicates * num_replicates
+        population.agents_per_age_group = list(self.agents_per_age_group)
+        for name in ['age_group_index', 'age', 'state', 'viralload', 'immunosenescence_factor', 'death_rate',
+                     'thresholds']:
+            setattr(population, name, np.tile(getattr(self, name), num_replicates))
+        return population
+
+    def to_agents(self, config=None):
+        # Agent objects for the agent-based engine
+        thresholds = self.thresholds.T.tolist()
+        return [Agent(state_names[state], viralload, age, config, age_group_index, thresholds[i])
+                for i, (state, viralload, age, age_group_index) in
+                enumerate(zip(self.state.tolist(), self.viralload.tolist(), self.age.tolist(),
+                              self.age_group_index.tolist()))]
+
+
+def population_layout(config):
+    # The part of a population that involves no random draws: the number of agents in each age group, and the age
+    # group, initial state and initial viral load of each agent
+    num_agents = config.num_agents
+    agents_per_age_group = [math.floor(w * num_agents) for w in config.age_probs]
+    if sum(agents_per_age_group) < num_agents:
+        agents_per_age_group[-1] += num_agents - sum(agents_per_age_group)
+
+    # Agents are assigned to age groups in order: agent i is in the first group whose cumulative count exceeds i
+    agent_index = np.arange(num_agents)
+    age_group_index = np.searchsorted(np.cumsum(agents_per_age_group), agent_index, side='right')
+
+    # The first agents start recovered, the next ones infected, then exposed, and the rest susceptible
+    initial_block = np.searchsorted(np.cumsum([config.num_recovered, config.num_infected, config.num_exposed]),
+                                    agent_index, side='right')
+    initial_state = np.array([R_STATE, I_STATE, E_STATE, S_STATE], dtype=np.int8)[initial_block]
+    initial_viralload = np.array([0, (config.thresh2 + config.thresh3) / 2,
+                                  (config.thresh1 + config.thresh2) / 2, 0])[initial_block]
+    return agents_per_age_group, age_group_index, initial_state, initial_viralload
+
+
+# Populations built from population_seed, by content hash of the population parameters and the seed. The oldest
+# one is dropped once there are more than population_cache_size of them.
+population_cache = {}
+
+
+def population_key(config):
+    return config.content_hash(Population.parameter_names + ['population_seed'])
+
+
+def cached_population(config):
+    key = population_key(config)
+    population = population_cache.get(key)
+    if population is None:
+        population = Population(config, np.random.default_rng(config.population_seed))
+        population_cache[key] = population
+        while len(population_cache) > population_cache_size:
+            del population_cache[next(iter(population_cache))]
+    return population
+
+
+def initial_population(config, rng, num_replicates=1):
+    # A new population drawn from rng, or copies of the cached population of config.population_seed
+    if config.population_seed is None:
+        return Population(config, rng, num_replicates)
+    population = cached_population(config).tile(num_replicates)
+    if config.rejitter_population:
+        population.thresholds = jittered_thresholds(config, rng, population.thresholds.shape[1])
+    return population
+
+
+# Walker alias tables for sampling a column of each row of a probability matrix in O(1)
+def build_alias_tables(probability_matrix):
+    num_rows, num_columns = probability_matrix.shape
+    alias_probabilities = np.ones((num_rows, num_columns))
+    alias_indices = np.tile(np.arange(num_columns), (num_rows, 1))
+    for row in range(num_rows):
+        scaled = probability_matrix[row] * num_columns / np.sum(probability_matrix[row])
+        small = [column for column in range(num_columns) if scaled[column] < 1]
+        large = [column for column in range(num_columns) if scaled[column] >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            alias_probabilities[row, less] = scaled[less]
+            alias_indices[row, less] = more
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left is 1 up to rounding error and keeps its own column
+    return alias_probabilities, alias_indices
+
+
+# Contact sampler built once per population: agent indices sorted by age group, the start and size of
+# each age group in that index, and alias tables derived from the rows of the social interaction matrix
+class ContactSampler:
+    def __init__(self, age_group_index, interaction_matrix=social_interaction_matrix):
+        self.age_group_index = np.asarray(age_group_index)
+        self.num_agents = len(self.age_group_index)
+        self.num_age_groups = len(interaction_matrix)
+        self.agents_by_age_group = np.argsort(self.age_group_index, kind='stable')
+        self.age_group_sizes = np.bincount(self.age_group_index, minlength=self.num_age_groups)
+        self.age_group_starts = np.cumsum(self.age_group_sizes) - self.age_group_sizes
+        self.alias_probabilities, self.alias_indices = build_alias_tables(np.asarray(interaction_matrix, dtype=float))
+
+    def sample(self, num_contacts, rng):
+        return self.sample_batch(1, num_contacts, rng)
+
+    def sample_batch(self, num_replicates, num_contacts, rng):
+        # num_contacts contacts within each of num_replicates copies of the population, drawn in one call. Agent i of
+        # replicate r has the index r * num_agents + i, as in the flat arrays of AgentArrays(num_replicates=...).
+        total_contacts = num_replicates * num_contacts
+        # Choose the first agent uniformly and the age group of the second agent from the first agent's matrix row
+        agent1 = rng.integers(self.num_agents, size=total_contacts)
+        row = self.age_group_index[agent1]
+        column = rng.integers(self.num_age_groups, size=total_contacts)
+        keep_column = rng.random(total_contacts) < self.alias_probabilities[row, column]
+        age_group_index2 = np.where(keep_column, column, self.alias_indices[row, column])
+        # Same rule as the original interaction loop: the contact only happens if the
+        # index of the chosen age group is smaller than the number of agents in it
+        has_contact = age_group_index2 < self.age_group_sizes[age_group_index2]
+        agent1 = agent1[has_contact]
+        age_group_index2 = age_group_index2[has_contact]
+        # Choose the second agent uniformly within its age group
+        offset = rng.integers(self.age_group_sizes[age_group_index2])
+        agent2 = self.agents_by_age_group[self.age_group_starts[age_group_index2] + offset]
+        if num_replicates > 1:
+            replicate_start = np.repeat(np.arange(num_replicates) * self.num_agents, num_contacts)[has_contact]
+            agent1 = agent1 + replicate_start
+            agent2 = agent2 + replicate_start
+        return agent1, agent2
+
+
+# Apply the viral load transfer of a batch of contacts: in each susceptible-infected pair the susceptible agent
+# receives a third of the infected agent's load. Exposures of the same agent within a step are summed. Only the
+# receiving agents are touched, and their sorted indices are returned.
+def transmit_viral_load(state, viralload, agent1, agent2):
+    susceptible_first = (state[agent1] == S_STATE) & (state[agent2] == I_STATE)
+    infected_first = (state[agent1] == I_STATE) & (state[agent2] == S_STATE)
+    susceptible = np.concatenate((agent1[susceptible_first], agent2[infected_first]))
+    infected = np.concatenate((agent2[susceptible_first], agent1[infected_first]))
+    receivers, contact_receiver = np.unique(susceptible, return_inverse=True)
+    viralload[receivers] += np.bincount(contact_receiver, weights=viralload[infected] / 3, minlength=len(receivers))
+    return receivers
+
+
+# Single reduction over the agents for everything reported at the end of a time step. A bincount over the
+# combined (age group, state) code gives the state counts per age group, and the same bincount weighted by
+# viral load gives the load sums from which the averages over living agents are taken.
+def tally_states(state, age_group_index, viralload, num_age_groups=None):
+    if num_age_groups is None:
+        num_age_groups = len(age_groups)
+    num_states = len(state_names)
+    codes = np.asarray(age_group_index) * num_states + state
+    counts_by_age = np.bincount(codes, minlength=num_age_groups * num_states).reshape(-1, num_states)
+    load_sums_by_age = np.bincount(codes, weights=viralload,
+                                   minlength=num_age_groups * num_states).reshape(-1, num_states)
+    return summarize_tallies(counts_by_age, load_sums_by_age)
+
+
+# State counts and average viral loads from the (age group, state) counts and viral load sums
+def summarize_tallies(counts_by_age, load_sums_by_age):
+    state_count, avg_viral_load, avg_viral_load_by_age = tally_arrays(counts_by_age, load_sums_by_age)
+    state_count = state_count.tolist()
+    state_count_by_age = [tuple(counts) for counts in counts_by_age.tolist()]
+    return state_count, state_count_by_age, avg_viral_load, avg_viral_load_by_age.tolist()
+
+
+# Array form of summarize_tallies for counts and load sums of shape (..., age groups, states), e.g. one row of
+# age groups per replicate: returns the state counts (..., states), the average viral load (...) and the average
+# viral load by age group (..., age groups)
+def tally_arrays(counts_by_age, load_sums_by_age):
+    alive_by_age = counts_by_age[..., :D_STATE].sum(axis=-1)
+    alive_load_by_age = load_sums_by_age[..., :D_STATE].sum(axis=-1)
+    avg_viral_load = alive_load_by_age.sum(axis=-1) / alive_by_age.sum(axis=-1)
+    # Age groups without living agents have an average viral load of 0
+    avg_viral_load_by_age = np.divide(alive_load_by_age, alive_by_age,
+                                      out=np.zeros(alive_by_age.shape), where=alive_by_age > 0)
+    return counts_by_age.sum(axis=-2), avg_viral_load, avg_viral_load_by_age
+
+
+# Preallocated per-replicate buffer of agent viral loads. Column 0 holds the initial loads and column j the loads at
+# the end of time step j * every. Rows are the recorded agents sorted by age group, so the rows of one age group
+# form a contiguous block and by_age_group() returns a view instead of a copy.
+class TrajectoryRecorder:
+    def __init__(self, age_group_index, dtype=None, every=None, age_group_selection=None, config=None):
+        config = resolve_config(config)
+        dtype = config.trajectory_dtype if dtype is None else dtype
+        self.every = config.record_every if every is None else every
+        age_group_selection = config.record_age_groups if age_group_selection is None else age_group_selection
+        if age_group_selection is None:
+            age_group_selection = config.age_groups
+        age_group_index = np.asarray(age_group_index)
+        selected = np.isin(age_group_index, [config.age_groups.index(age_group) for age_group in age_group_selection])
+        agents_by_age_group = np.argsort(age_group_index, kind='stable')
+        self.agents = agents_by_age_group[selected[agents_by_age_group]]
+        self.age_group_index = age_group_index[self.agents]
+        group_sizes = np.bincount(self.age_group_index, minlength=len(config.age_groups))
+        self.age_group_stops = np.cumsum(group_sizes)
+        self.age_group_starts = self.age_group_stops - group_sizes
+        self.steps = np.arange(0, config.time_steps + 1, self.every)
+        self.data = np.zeros((len(self.agents), len(self.steps)), dtype=dtype)
+        self.row_of_agent = np.full(len(age_group_index), -1)
+        self.row_of_agent[self.agents] = np.arange(len(self.agents))
+
+    def record(self, t, viralload):
+        # t is the number of completed time steps, 0 for the initial loads
+        if t % self.every == 0:
+            self.data[:, t // self.every] = viralload[self.agents]
+
+    def record_agents(self, t, agents, viralload):
+        # Record only the given agents; every other recorded agent keeps the zero the buffer was created with
+        if t % self.every == 0:
+            rows = self.row_of_agent[agents]
+            recorded = rows >= 0
+            self.data[rows[recorded], t // self.every] = viralload[agents[recorded]]
+
+    def by_age_group(self, age_group_index):
+        # Viral loads of the recorded agents of one age group, shape (agents, recorded steps)
+        return self.data[self.age_group_starts[age_group_index]:self.age_group_stops[age_group_index]]
+
+
+# Viral load histories of a population in CSR form: the nonzero viral loads of agent i after each state update, in
+# time order, are values[offsets[i]:offsets[i + 1]]. The engines lay the population out by age group, so the agents
+# of each age group are one contiguous block whose values and offsets can be taken without copying (by_age_group).
+# Sums over histories are segmented reductions of the flat values, with no padding to a common length.
+class RaggedHistories:
+    def __init__(self, values, offsets, age_group_index, num_age_groups):
+        self.values = values
+        self.offsets = offsets
+        self.age_group_index = np.asarray(age_group_index)
+        self.num_age_groups = num_age_groups
+        # The agents of age group g are agent_offsets[g] to agent_offsets[g + 1]
+        self.agent_offsets = np.searchsorted(self.age_group_index, np.arange(num_age_groups + 1))
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def agents_per_age_group(self):
+        return np.diff(self.agent_offsets)
+
+    def by_age_group(self, age_group_index):
+        # Values and offsets of the histories of one age group; the values are a view
+        first_agent, stop_agent = self.agent_offsets[age_group_index:age_group_index + 2]
+        offsets = self.offsets[first_agent:stop_agent + 1]
+        return self.values[offsets[0]:offsets[-1]], offsets - offsets[0]
+
+    def position_sums(self, max_length):
+        # Sum of the histories of each age group by position in the history, shape (age groups, max_length), from
+        # one bincount over the combined (age group, position) code of every value
+        lengths = self.lengths()
+        position = np.arange(len(self.values)) - np.repeat(self.offsets[:-1], lengths)
+        codes = np.repeat(self.age_group_index, lengths) * max_length + position
+        return np.bincount(codes, weights=self.values,
+                           minlength=self.num_age_groups * max_length).reshape(self.num_age_groups, max_length)
+
+    def max_lengths_by_age(self):
+        # Longest history in each age group, one segmented maximum over the age group blocks
+        max_lengths = np.zeros(self.num_age_groups, dtype=np.int64)
+        nonempty = self.agents_per_age_group() > 0
+        if nonempty.any():
+            max_lengths[nonempty] = np.maximum.reduceat(self.lengths(), self.agent_offsets[:-1][nonempty])
+        return max_lengths
+
+    def to_lists(self):
+        # History of each agent as a list, as Agent.viral_load_history holds it
+        return [history.tolist() for history in np.split(self.values, self.offsets[1:-1])]
+
+
+def ragged_histories(loads, age_group_index, num_age_groups):
+    # RaggedHistories of the nonzero entries of each row of an (agents, time steps) buffer
+    has_history = loads > 0
+    return RaggedHistories(loads[has_history], np.concatenate(([0], np.cumsum(has_history.sum(axis=1)))),
+                           age_group_index, num_age_groups)
+
+
+# Columns of the per-agent infection kinetics table. Days count completed time steps (0 is the initial state), loads
+# are the viral load after each day's state update, and the area under the curve adds up the daily loads. Agents that
+# were never exposed or infected have -1 in infection_day and time_to_peak. outcome_day, time_to_outcome and outcome
+# (the state code R or D) are -1 until the agent recovers or dies.
+kinetics_dtype = np.dtype([('age_group', np.int8), ('infection_day', np.int32), ('peak_day', np.int32),
+                           ('time_to_peak', np.int32), ('peak_load', np.float64), ('auc', np.float64),
+                           ('days_exposed', np.int32), ('days_infected', np.int32), ('outcome_day', np.int32),
+                           ('time_to_outcome', np.int32), ('outcome', np.int8)])
+
+
+# Fixed-width kinetics record of every agent, updated as the engine steps: the day the agent was first exposed or
+# infected, its peak load and the day of the peak, the sum of its daily loads and the day it recovered or died.
+# update() can be limited to the agents whose state or load can change, e.g. the active set of AgentArrays.
+class InfectionKinetics:
+    def __init__(self, age_group_index, state, viralload):
+        self.age_group_index = age_group_index
+        infected = (state == E_STATE) | (state == I_STATE)
+        self.infection_day = np.where(infected, 0, -1)
+        self.peak_load = np.asarray(viralload, dtype=float).copy()
+        self.peak_day = np.zeros(len(state), dtype=np.int64)
+        self.auc = np.zeros(len(state))
+        self.outcome_day = np.full(len(state), -1)
+        self.outcome = np.full(len(state), -1, dtype=np.int8)
+
+    def update(self, day, state, viralload, agents=slice(None)):
+        # Fold in the state and viral load of the given agents after the state update of day
+        if isinstance(agents, slice):
+            agents = np.arange(len(state))[agents]
+        agent_state = state[agents]
+        agent_load = viralload[agents]
+        self.auc[agents] += agent_load
+        higher = agent_load > self.peak_load[agents]
+        self.peak_load[agents[higher]] = agent_load[higher]
+        self.peak_day[agents[higher]] = day
+        newly_infected = agents[((agent_state == E_STATE) | (agent_state == I_STATE))
+                                & (self.infection_day[agents] < 0)]
+        self.infection_day[newly_infected] = day
+        ended = ((agent_state == R_STATE) | (agent_state == D_STATE)) & (self.infection_day[agents] >= 0) \
+            & (self.outcome[agents] < 0)
+        self.outcome_day[agents[ended]] = day
+        self.outcome[agents[ended]] = agent_state[ended]
+
+    def add_loads(self, first_day, loads):
+        # Daily loads of days first_day, first_day + 1, ... of every agent, with no state changes (extinct epidemic)
+        self.auc += loads.sum(axis=1)
+        peak_step = loads.argmax(axis=1)
+        peak_load = loads[np.arange(len(loads)), peak_step]
+        higher = peak_load > self.peak_load
+        self.peak_load[higher] = peak_load[higher]
+        self.peak_day[higher] = first_day + peak_step[higher]
+
+    def table(self, days_exposed, days_infected, agents=slice(None)):
+        # Kinetics table of the given agents, one row each
+        table = np.zeros(len(self.peak_load[agents]), dtype=kinetics_dtype)
+        infection_day = self.infection_day[agents]
+        infected = infection_day >= 0
+        ended = self.outcome[agents] >= 0
+        table['age_group'] = self.age_group_index[agents]
+        table['infection_day'] = infection_day
+        table['peak_day'] = self.peak_day[agents]
+        table['time_to_peak'] = np.where(infected, self.peak_day[agents] - infection_day, -1)
+        table['peak_load'] = self.peak_load[agents]
+        table['auc'] = self.auc[agents]
+        table['days_exposed'] = days_exposed[agents]
+        table['days_infected'] = days_infected[agents]
+        table['outcome_day'] = self.outcome_day[agents]
+        table['time_to_outcome'] = np.where(ended, self.outcome_day[agents] - infection_day, -1)
+        table['outcome'] = self.outcome[agents]
+        return table
+
+
+# Per age group sums over the infections of a kinetics table, in the columns of kinetics_summary_fields, and the
+# number of infections. outcomes counts the infections that ended and deaths those that ended in death;
+# time_to_outcome only adds up the infections that ended.
+kinetics_summary_fields = ['peak_load', 'time_to_peak', 'auc', 'days_exposed', 'days_infected', 'outcomes',
+                           'deaths', 'time_to_outcome']
+
+
+def kinetics_sums(table, num_age_groups):
+    infected = table[table['infection_day'] >= 0]
+    age_group = infected['age_group']
+    ended = infected['outcome'] >= 0
+    columns = {'outcomes': ended, 'deaths': infected['outcome'] == D_STATE,
+               'time_to_outcome': np.where(ended, infected['time_to_outcome'], 0)}
+    sums = np.zeros((num_age_groups, len(kinetics_summary_fields)))
+    for column, field in enumerate(kinetics_summary_fields):
+        values = columns[field] if field in columns else infected[field]
+        sums[:, column] = np.bincount(age_group, weights=values, minlength=num_age_groups)
+    return sums, np.bincount(age_group, minlength=num_age_groups)
+
+
+# One state transition: the agent, the day it happened on (as in the kinetics table), the states before and after and
+# the agent's viral load right after the transition
+event_dtype = np.dtype([('agent', np.int32), ('day', np.int32), ('from_state', np.int8), ('to_state', np.int8),
+                        ('viral_load', np.float64)])
+
+
+# Append-only log of state transitions in one growing array of event_dtype, doubled in size whenever it is full.
+# Events are appended a day at a time, so the log is sorted by day.
+class EventLog:
+    def __init__(self, capacity=1024):
+        self.data = np.zeros(capacity, dtype=event_dtype)
+        self.size = 0
+
+    def append(self, day, agents, from_state, to_state, viral_load):
+        size = self.size + len(agents)
+        if size > len(self.data):
+            data = np.zeros(max(size, 2 * len(self.data)), dtype=event_dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        events = self.data[self.size:size]
+        events['agent'] = agents
+        events['day'] = day
+        events['from_state'] = from_state
+        events['to_state'] = to_state
+        events['viral_load'] = viral_load
+        self.size = size
+
+    def record_changes(self, day, agents, state_before, state, viralload):
+        # Log the agents among the given ones whose state differs from state_before (their states before the day)
+        changed = state[agents] != state_before
+        agents = agents[changed]
+        self.append(day, agents, state_before[changed], state[agents], viralload[agents])
+
+    def events(self):
+        return self.data[:self.size]
+
+
+# Rebuild the tallies of a run from its event log. state_dynamics_by_age has shape (age groups, time steps, states)
+# and state_counts (time steps + 1, states), as in a compact result; the first row of state_counts follows the
+# engines, which count the initially recovered agents as susceptible there.
+def replay_state_dynamics(events, config=None):
+    config = resolve_config(config)
+    _, age_group_index, initial_state, _ = population_layout(config)
+    num_age_groups, num_states = len(config.age_groups), len(state_names)
+    num_codes = config.time_steps * num_age_groups * num_states
+    initial_counts = np.bincount(age_group_index * num_states + initial_state, minlength=num_age_groups * num_states)
+    # Every event moves one agent of its age group from one state to another on its day
+    day_codes = ((events['day'] - 1) * num_age_groups + age_group_index[events['agent']]) * num_states
+    changes = np.bincount(day_codes + events['to_state'], minlength=num_codes) \
+        - np.bincount(day_codes + events['from_state'], minlength=num_codes)
+    counts = initial_counts + np.cumsum(changes.reshape(config.time_steps, num_age_groups * num_states), axis=0)
+    counts = counts.reshape(config.time_steps, num_age_groups, num_states)
+    state_counts = np.vstack([[config.num_agents - (config.num_infected + config.num_exposed), config.num_exposed,
+                               config.num_infected, 0, 0], counts.sum(axis=1)])
+    return state_counts, counts.transpose(1, 0, 2)
+
+
+def prevalence_by_age(state_dynamics_by_age, config=None, state=I_STATE):
+    # Fraction of each age group in the given state (infected by default) at each time step
+    config = resolve_config(config)
+    agents_per_age_group = np.array(population_layout(config)[0])
+    return state_dynamics_by_age[:, :, state] / np.maximum(agents_per_age_group, 1)[:, np.newaxis]
+
+
+# Wall time, call counts and optionally allocated memory blocks of each phase of a simulation. The engines call
+# lap(phase) at the end of every phase, which charges the time since the previous lap to that phase. Every engine
+# laps each phase at most once per step and charges the same work to it, so the tables compare across engines:
+# agent_updates includes writing the viral load history buffer, kinetics is the infection kinetics table and the
+# event log, and recording is the trajectory column. Profiling is
+# off unless config.profile is set; the engines then hold None instead of a profiler and skip every lap.
+# The allocation count is the net change of sys.getallocatedblocks() over the phase.
+class PhaseProfiler:
+    phases = ['setup', 'agent_updates', 'max_load_tracking', 'contacts', 'state_tallies', 'kinetics', 'age_averages',
+              'recording', 'extinction_fill']
+
+    def __init__(self, track_allocations=False):
+        self.track_allocations = track_allocations
+        self.replicates = 0
+        self.seconds = dict.fromkeys(self.phases, 0.0)
+        self.calls = dict.fromkeys(self.phases, 0)
+        self.allocated_blocks = dict.fromkeys(self.phases, 0)
+        self.last_time = None
+        self.last_blocks = 0
+
+    def start(self):
+        self.replicates += 1
+        self.last_time = time.perf_counter()
+        if self.track_allocations:
+            self.last_blocks = sys.getallocatedblocks()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.seconds[phase] += now - self.last_time
+        self.calls[phase] += 1
+        self.last_time = now
+        if self.track_allocations:
+            blocks = sys.getallocatedblocks()
+            self.allocated_blocks[phase] += blocks - self.last_blocks
+            self.last_blocks = blocks
+
+    def as_dict(self):
+        # Plain form of the profile that is returned from worker processes with the compact result
+        return {'replicates': self.replicates, 'track_allocations': self.track_allocations,
+                'seconds': dict(self.seconds), 'calls': dict(self.calls),
+                'allocated_blocks': dict(self.allocated_blocks)}
+
+    def merge(self, profile):
+        # Add the profile of another replicate, given as a PhaseProfiler or in its as_dict() form
+        if isinstance(profile, PhaseProfiler):
+            profile = profile.as_dict()
+        self.replicates += profile['replicates']
+        self.track_allocations = self.track_allocations or profile['track_allocations']
+        # Profiles saved before a phase existed count it as zero
+        for phase in self.phases:
+            self.seconds[phase] += profile['seconds'].get(phase, 0.0)
+            self.calls[phase] += profile['calls'].get(phase, 0)
+            self.allocated_blocks[phase] += profile['allocated_blocks'].get(phase, 0)
+
+    def summary_table(self):
+        total_seconds = sum(self.seconds.values())
+        replicates = max(self.replicates, 1)
+        header = "{:<20} {:>12} {:>8} {:>10} {:>14} {:>14}".format(
+            "Phase", "Total (s)", "Share", "Calls", "Per call (us)", "Per rep. (ms)")
+        if self.track_allocations:
+            header += " {:>14}".format("Alloc. blocks")
+        rows = [f"Phase profile over {self.replicates} replicates", header]
+        for phase in self.phases + ['total']:
+            if phase == 'total':
+                seconds, calls, blocks = total_seconds, sum(self.calls.values()), sum(self.allocated_blocks.values())
+            else:
+                seconds, calls, blocks = self.seconds[phase], self.calls[phase], self.allocated_blocks[phase]
+            row = "{:<20} {:>12.4f} {:>7.1%} {:>10} {:>14.2f} {:>14.3f}".format(
+                phase, seconds, seconds / total_seconds if total_seconds else 0.0, calls,
+                1e6 * seconds / calls if calls else 0.0, 1e3 * seconds / replicates)
+            if self.track_allocations:
+                row += " {:>14}".format(blocks)
+            rows.append(row)
+        return '\n'.join(rows)
+
+
+def start_profiler(config):
+    if not config.profile:
+        return None
+    profiler = PhaseProfiler(config.profile_allocations)
+    profiler.start()
+    return profiler
+
+
+# The epidemic is over when no agent is exposed or infected and no susceptible agent holds viral load: from then
+# on no agent changes state and contacts transmit nothing, so the only thing left to simulate is recovered
+# agents clearing their remaining viral load.
+def is_extinct(state, viralload):
+    return not np.any((state == E_STATE) | (state == I_STATE) | ((state == S_STATE) & (viralload > 0)))
+
+
+# Viral load of every agent after each of the num_steps remaining steps of an extinct epidemic, shape
+# (agents, num_steps). Recovered agents lose uniform(0, 1) * immunosenescence factor / 3 per step until they
+# reach zero, which is a cumulative sum of all their draws clipped at zero; dead agents are cleared on the first
+# step and every other agent has no viral load.
+def decay_after_extinction(state, viralload, immunosenescence_factor, num_steps, rng):
+    loads = np.zeros((len(viralload), num_steps))
+    decaying = np.flatnonzero((state == R_STATE) & (viralload > 0))
+    decrements = rng.random((len(decaying), num_steps)) * immunosenescence_factor[decaying, None] / 3
+    loads[decaying] = np.maximum(viralload[decaying, None] - np.cumsum(decrements, axis=1), 0)
+    return loads
+
+
+# Append the outputs of the time steps after first_step of an extinct epidemic, one column of loads per step.
+# The states no longer change, so only the viral load sums differ from step to step.
+def record_extinct_steps(first_step, state, agent_age_group_index, loads, config, state_counts, state_dynamics_by_age,
+                         avg_viral_loads, avg_viral_loads_by_age, trajectory):
+    for step in range(loads.shape[1]):
+        state_count, state_count_by_age, avg_viral_load, avg_viral_load_by_age = \
+            tally_states(state, agent_age_group_index, loads[:, step], len(config.age_groups))
+        state_counts.append(state_count)
+        for age_group_index, age_group in enumerate(config.age_groups):
+            state_dynamics_by_age[age_group].append(state_count_by_age[age_group_index])
+            avg_viral_loads_by_age[age_group_index].append(avg_viral_load_by_age[age_group_index])
+        avg_viral_loads.append(avg_viral_load)
+        trajectory.record(first_step + step + 1, loads[:, step])
+
+
+# Per-simulation report: people and deaths by age group and maximum viral loads. Timings are reported by
+# PhaseProfiler instead. pandas is only imported here, so processes that run quiet simulations never load it.
+def print_simulation_report(simulation_number, config, people_count, deaths_by_ages, max_viral_loads_by_age):
+    import pandas as pd
+    age_df = pd.DataFrame({'Age Group': config.age_groups, 'People': people_count, 'Deaths': deaths_by_ages})
+    print(age_df)
+    # Print the maximum viral load for each age group
+    for age_group_index, age_group in enumerate(config.age_groups):
+        max_viral_load = max_viral_loads_by_age[age_group_index]
+        print(f"Maximum Viral Load for {age_group}: {max_viral_load}")
+    print(f"Standard Deviation of Maximum Viral Loads: {np.std(max_viral_loads_by_age)}")
+    print(f"Simulation {simulation_number} completed.")
+
+
 # Define simulation function
-def simulate(simulation_number):
-    start_time_simulation = time.time()
-    # Initialize agents
-    agents = []
-    people_count = [0] * len(age_groups)
-    deaths_by_ages = [0] * len(death_rates)
+def simulate(simulation_number, rng=None, compact=False, config=None):
+    config = resolve_config(config)
+    profiler = start_profiler(config)
+    # Every random number of the replicate comes from rng, a Generator of its own
+    if rng is None:
+        rng = np.random.default_rng()
+    # Initialize agents from a population built with bulk draws (or reused from the population cache)
+    population = initial_population(config, rng)
+    agents = population.to_agents(config)
+    if compact:
+        for agent in agents:
+            agent.viral_load_history = None
+    people_count = population.agents_per_age_group
+    deaths_by_ages = [0] * len(config.death_rates)
 
 
     # Empty list to append the average viral loads at each time step
     avg_viral_loads = []
-    # Initialize a list to store viral load data for each agent at each time step
-    viral_load_data_by_agent = []
-    agents_per_age_group = [math.floor(w * num_agents) for w in age_probs]
-    if sum(agents_per_age_group) < num_agents:
-        agents_per_age_group[-1] += num_agents-sum(agents_per_age_group)
-    cumulative_agents_per_group = np.cumsum(agents_per_age_group)
-    for i in range(num_agents):
-        if i < num_recovered:
-            state = 'R'
-            viralload = 0
-        elif i < (num_infected + num_recovered):
-            state = 'I'
-            viralload = (thresh2 + thresh3) / 2
-            # viralload = thresh2 + (random.random() - 0.5) * (thresh3 - thresh2)
-        elif i < (num_infected + num_exposed + num_recovered):
-            state = 'E'
-            viralload = (thresh1 + thresh2) / 2
-            # viralload = thresh1 + (random.random() - 0.5) * (thresh2 - thresh1)
-        else:
-            state = 'S'
-            viralload = 0
-
-        index_of_age_group = next(x for x, val in enumerate(cumulative_agents_per_group)
-        if val > i)
-        # age_probs_normalized = [prob / sum(age_probs) for prob in age_probs]
-
-        age_range = age_groups[index_of_age_group].split('-')
-        age = random.randint(int(age_range[0]), int(age_range[1]))
-
-        agent = Agent(state, viralload, age)
-        agents.append(agent)
-        viral_load_data_by_agent.append([])
-        # Increment the people count for the corresponding age group
-        people_count = agents_per_age_group
 
     # Run simulation
     state_counts = []
-    state_counts.append([num_agents-(num_infected+num_exposed), num_exposed, num_infected, 0, 0])
-    state_dynamics_by_age = {age_group: [] for age_group in age_groups}  # Dictionary of state dynamics in each age group
-    viral_load_data = [[] for _ in range(num_agents)]
-    # Create lists to store viral load data for each age group
-    viral_load_data_by_age = [[] for _ in range(len(age_groups))]
+    state_counts.append([config.num_agents-(config.num_infected+config.num_exposed), config.num_exposed,
+                         config.num_infected, 0, 0])
+    # Dictionary of state dynamics in each age group
+    state_dynamics_by_age = {age_group: [] for age_group in config.age_groups}
+    # Viral load of each agent after its state update at each time step, the loads its viral load history keeps
+    viral_load_after_update = np.zeros((config.num_agents, config.time_steps))
+    record_trajectories = config.record_trajectories or not compact
     # Create a list to store the average viral loads for each age group at each time step
-    avg_viral_loads_by_age = [[] for _ in range(len(age_groups))]
+    avg_viral_loads_by_age = [[] for _ in range(len(config.age_groups))]
     # Create lists to store maximum viral loads for each age group
-    max_viral_loads_by_age = [0.0] * len(age_groups)
-    # Create a list to store viral load data for each time step and each age group
-    viral_load_data_by_age_and_time = [[[] for _ in range(time_steps)] for _ in range(len(age_groups))]
-    std_dev_max_viral_loads_by_age = []
+    max_viral_loads_by_age = [0.0] * len(config.age_groups)
     days_exposed = []
     days_infected = []
-    for t in range(time_steps):
-        # Update agent states
-        for agent in agents:
+    # Build the contact sampler once for this population
+    agent_age_group_index = population.age_group_index
+    # Preallocated buffer for the viral load of each agent at each time step
+    trajectory = TrajectoryRecorder(agent_age_group_index, config=config,
+                                    age_group_selection=None if record_trajectories else [])
+    trajectory.record(0, np.array([agent.viralload for agent in agents]))
+    kinetics = InfectionKinetics(agent_age_group_index, population.state, population.viralload)
+    events = EventLog()
+    previous_states = population.state
+    agents_in_age_group = [np.flatnonzero(agent_age_group_index == index) for index in range(len(config.age_groups))]
+    contact_sampler = ContactSampler(agent_age_group_index, config.social_interaction_matrix)
+    contacts_per_step = round(config.contacts_per_agent * config.num_agents)
+    if profiler:
+        profiler.lap('setup')
+    for t in range(config.time_steps):
+        # Update agent states. An agent draws at most two uniforms per step, so all of them are drawn in one call
+        # and handed out in agent order.
+        uniform = iter(rng.random(2 * config.num_agents).tolist()).__next__
+        for i, agent in enumerate(agents):
             # neighbors = [neighbor for neighbor in agents if neighbor != agent]
-            agent.update_state(deaths_by_ages)
-
-            # Get the age group of the current agent
-            age_group_index = agent.age_group_index
-            if age_group_index is not None:
-                # Append viral load data to corresponding age group list
-                viral_load_data_by_age[age_group_index].append(agent.viralload)
-                # print(viral_load_data_by_age)
-                # Calculate the maximum viral load for each agent within their age group
+            agent.update_state(deaths_by_ages, uniform)
+            viral_load_after_update[i, t] = agent.viralload
+        if profiler:
+            profiler.lap('agent_updates')
         for agent in agents:
             age_group_index = agent.age_group_index
             max_viral_loads_by_age[age_group_index] = max(max_viral_loads_by_age[age_group_index], agent.viralload)
-
-        # Create a social interaction matrix based on age group
-        social_interaction_matrix = np.array([
-            [2.5982, 0.8003, 0.3160, 0.7934, 0.3557, 0.1548, 0.0564],
-            [0.6473, 4.1960, 0.6603, 0.5901, 0.4665, 0.1238, 0.0515],
-            [0.1737, 1.7500, 11.1061, 0.9782, 0.7263, 0.0815, 0.0273],
-            [0.5504, 0.5906, 1.2004, 1.8813, 0.9165, 0.1370, 0.0397],
-            [0.3894, 0.7848, 1.3139, 1.1414, 1.3347, 0.2260, 0.0692],
-            [0.3610, 0.3918, 0.3738, 0.5248, 0.5140, 0.7072, 0.1469],
-            [0.1588, 0.3367, 0.3406, 0.2286, 0.3637, 0.3392, 0.3868]
-        ])
-        # Normalize the social interaction matrix and compute rolling sums of the rows
-        normalized_matrix = social_interaction_matrix / np.sum(social_interaction_matrix, axis=1, keepdims=True)
-        row_sums = np.cumsum(normalized_matrix, axis=1)
-
-        # Modify the interaction loop inside the simulation
-        for _ in range(200):
-            # print("random interaction")
-            agent1 = random.choice(agents)  # Choose a random agent
-
-            # Choose the second agent based on age group using the rolling sums
-            random_value = random.random()
-            age_group1 = age_groups[agent1.age_group_index]
-            age_group_index1 = age_groups.index(age_group1)
-
-            probabilities = row_sums[age_group_index1]
-            age_group_index2 = np.argmax(
-                probabilities > random_value)  # Find the first index where probability exceeds random_value
-            age_group2 = age_groups[age_group_index2]  # Get the age group based on the index
-            agents_in_age_group2 = [agent for agent in agents if age_groups[agent.age_group_index] == age_group2]
-            if age_group_index2 < len(agents_in_age_group2):
-                agent2 = random.choice(agents_in_age_group2)
-
-                # Check if one agent is susceptible and the other is infected
-                if (agent1.get_state() == 'S') and agent2.get_state() == 'I':
-                    susceptible_exposed_agent = agent1
-                    infected_agent = agent2
-                elif agent1.get_state() == 'I' and (agent2.get_state() == 'S'):
-                    susceptible_exposed_agent = agent2
-                    infected_agent = agent1
-                else:
-                    continue
-
-                susceptible_exposed_agent.viralload += infected_agent.viralload / 3
-
-
-        # Record state counts
-        s_count = sum([1 for agent in agents if agent.get_state() == 'S'])
-        e_count = sum([1 for agent in agents if agent.get_state() == 'E'])
-        i_count = sum([1 for agent in agents if agent.get_state() == 'I'])
-        r_count = sum([1 for agent in agents if agent.get_state() == 'R'])
-        d_count = sum([1 for agent in agents if agent.get_state() == 'D'])
-        state_counts.append([s_count, e_count, i_count, r_count, d_count])
-
-        # Calculate state dynamics for each age group
-        for age_group in age_groups:
-            s_count_age = sum(1 for agent in agents if  age_groups[agent.age_group_index] == age_group and agent.get_state() == 'S')
-            e_count_age = sum(1 for agent in agents if  age_groups[agent.age_group_index] == age_group and agent.get_state() == 'E')
-            i_count_age = sum(1 for agent in agents if  age_groups[agent.age_group_index] == age_group and agent.get_state() == 'I')
-            r_count_age = sum(1 for agent in agents if  age_groups[agent.age_group_index] == age_group and agent.get_state() == 'R')
-            d_count_age = sum(1 for agent in agents if  age_groups[agent.age_group_index] == age_group and agent.get_state() == 'D')
-            state_dynamics_by_age[age_group].append((s_count_age, e_count_age, i_count_age, r_count_age, d_count_age))
-
-        ## Calculate the average viral load for all agents
-        avg_viral_load = sum(agent.viralload for agent in agents if agent.get_state() != 'D') \
-            / len([agent for agent in agents if agent.get_state() != 'D'])
-        avg_viral_loads.append(avg_viral_load)
-        # print(avg_viral_loads)
-        # Calculate the standard deviation of the maximum viral loads across all age groups
-        std_dev_max_viral_loads_by_age = np.std(max_viral_loads_by_age)
-
-        # Calculate average viral loads for each age group
-        for age_group_index, age_group in enumerate(age_groups):
-            agents_in_age_group = [agent for agent in agents if
-                                   age_groups[agent.age_group_index] == age_group and agent.get_state() != 'D']
-            if agents_in_age_group:
-                avg_load_at_time_step = sum(agent.viralload for agent in agents_in_age_group) / len(agents_in_age_group)
-                # Update the maximum viral load for the age group
+        if profiler:
+            profiler.lap('max_load_tracking')
+
+        # Draw all of this time step's contacts in one batch
+        agent1_indices, agent2_indices = contact_sampler.sample(contacts_per_step, rng)
+        for agent1_index, agent2_index in zip(agent1_indices, agent2_indices):
+            agent1 = agents[agent1_index]
+            agent2 = agents[agent2_index]
+
+            # Check if one agent is susceptible and the other is infected
+            if (agent1.get_state() == 'S') and agent2.get_state() == 'I':
+                susceptible_exposed_agent = agent1
+                infected_agent = agent2
+            elif agent1.get_state() == 'I' and (agent2.get_state() == 'S'):
+                susceptible_exposed_agent = agent2
+                infected_agent = agent1
             else:
-                avg_load_at_time_step = 0  # Handle the case where there are no agents in the age group
-            avg_viral_loads_by_age[age_group_index].append(avg_load_at_time_step)
-
-
-        # Append viral load data for each agent at the current time step
-        for i, agent in enumerate(agents):
-            viral_load_data[i].append(agent.viralload)
-            viral_load_data_by_agent[i].append(agent.viralload)
-            age_group_index = agent.age_group_index
-            viral_load_data_by_age_and_time[age_group_index][t].append(agent.viralload)
+                continue
+
+            susceptible_exposed_agent.viralload += infected_agent.viralload / 3
+        if profiler:
+            profiler.lap('contacts')
+
+
+        # Record state counts, state dynamics and average viral loads by age group in one pass over the agents
+        agent_states = np.array([state_codes[agent.state] for agent in agents], dtype=np.int8)
+        agent_viralloads = np.array([agent.viralload for agent in agents])
+        state_count, state_count_by_age, avg_viral_load, avg_viral_load_by_age = \
+            tally_states(agent_states, agent_age_group_index, agent_viralloads, len(config.age_groups))
+        state_counts.append(state_count)
+        if profiler:
+            profiler.lap('state_tallies')
+        # Contacts only change loads, so these are also the states right after the update
+        kinetics.update(t + 1, agent_states, viral_load_after_update[:, t])
+        if config.record_events:
+            events.record_changes(t + 1, np.arange(config.num_agents), previous_states, agent_states,
+                                  viral_load_after_update[:, t])
+            previous_states = agent_states
+        if profiler:
+            profiler.lap('kinetics')
+        for age_group_index, age_group in enumerate(config.age_groups):
+            state_dynamics_by_age[age_group].append(state_count_by_age[age_group_index])
+            avg_viral_loads_by_age[age_group_index].append(avg_viral_load_by_age[age_group_index])
+        avg_viral_loads.append(avg_viral_load)
+        if profiler:
+            profiler.lap('age_averages')
+
+        # Record the viral load of each agent at the current time step
+        trajectory.record(t + 1, agent_viralloads)
+        if profiler:
+            profiler.lap('recording')
+
+        if config.stop_at_extinction and t + 1 < config.time_steps and is_extinct(agent_states, agent_viralloads):
+            immunosenescence = np.array([agent.immunosenescence_factor for agent in agents])
+            loads = decay_after_extinction(agent_states, agent_viralloads, immunosenescence,
+                                           config.time_steps - t - 1, rng)
+            record_extinct_steps(t + 1, agent_states, agent_age_group_index, loads, config, state_counts,
+                                 state_dynamics_by_age, avg_viral_loads, avg_viral_loads_by_age, trajectory)
+            viral_load_after_update[:, t + 1:] = loads
+            kinetics.add_loads(t + 2, loads)
+            for agent, agent_loads in zip(agents, loads):
+                agent.viralload = float(agent_loads[-1])
+                if not compact:
+                    agent.viral_load_history.extend(agent_loads[agent_loads > 0].tolist())
+            if profiler:
+                profiler.lap('extinction_fill')
+            break
 
 
     for agent in agents:
         days_exposed.append(agent.days_exposed)
         days_infected.append(agent.days_infected)
 
-    age_df = pd.DataFrame({'Age Group': age_groups, 'People': people_count, 'Deaths': deaths_by_ages})
-    print(age_df)
-
-    # Calculate areas under the viral load curves for each age group
-    for age_viral_loads in viral_load_data_by_age:
-        area_under_curve = np.trapz(age_viral_loads)
-        viral_load_areas.append(area_under_curve)
-
-    # Print the areas under the viral load curves for each age group and max avg viral load
-    # print("Areas under viral load curves:", viral_load_areas)
-    # Print the maximum viral load for each age group
-    for age_group_index, age_group in enumerate(age_groups):
-        max_viral_load = max_viral_loads_by_age[age_group_index]
-        print(f"Maximum Viral Load for {age_group}: {max_viral_load}")
-    print(f"Standard Deviation of Maximum Viral Loads: {std_dev_max_viral_loads_by_age}")
-
 
     #     # Print ages of all agents
     # for i, agent in enumerate(agents):
@@ -342,14 +1008,474 @@ def simulate(simulation_number):
     #         for i, agent_data in enumerate(transposed_data):
     #             writer.writerow(agent_data)  # Write agent ID and viral load data
 
-    print(f"Simulation {simulation_number} completed.")
-    end_time_simulation = time.time()  # Record the end time of the simulation
-    total_time = end_time_simulation - start_time_simulation  # Calculate the total time taken
-    print(f"Time taken for simulation {simulation_number}: {total_time} seconds")
+    if config.verbose:
+        print_simulation_report(simulation_number, config, people_count, deaths_by_ages, max_viral_loads_by_age)
+
+    if compact:
+        histories = ragged_histories(viral_load_after_update, agent_age_group_index, len(config.age_groups))
+        result = compact_result(state_counts, agents, avg_viral_loads, state_dynamics_by_age, avg_viral_loads_by_age,
+                                trajectory, days_exposed, days_infected, config, histories)
+        result['kinetics'] = kinetics.table(result['days_exposed'], result['days_infected'])
+        if config.record_events:
+            result['events'] = events.events()
+            result['deaths_by_age'] = np.array(deaths_by_ages)
+        if profiler:
+            result['phase_profile'] = profiler.as_dict()
+        return result
+    # Viral loads of each age group, time step by time step
+    viral_load_data_by_age = [viral_load_after_update[members].T.ravel() for members in agents_in_age_group]
+    # Recorded time steps after the initial one
+    viral_load_data = trajectory.data[:, 1:]
+    viral_load_data_by_age_and_time = [trajectory.by_age_group(age_group_index)[:, 1:].T
+                                       for age_group_index in range(len(config.age_groups))]
+    return state_counts, agents, avg_viral_loads, state_dynamics_by_age, avg_viral_loads_by_age, viral_load_data_by_age, \
+            viral_load_data, viral_load_data_by_age_and_time, days_exposed, days_infected
+
 
+# Struct-of-arrays version of the agent population used by the vectorized engine.
+# Entry i of every array describes the same agent that simulate() stores in agents[i]. With num_replicates > 1
+# the arrays hold that many independent copies of the population back to back, agent i of replicate r at
+# index r * num_agents + i, for the batched engine. The initial arrays come from a Population.
+class AgentArrays:
+    def __init__(self, num_agents, rng, config=None, num_replicates=1, population=None):
+        config = resolve_config(config)
+        if num_agents != config.num_agents:
+            config = config.replace(num_agents=num_agents)
+        self.config = config
+        self.num_replicates = num_replicates
+        if population is None:
+            population = initial_population(config, rng, num_replicates)
+        self.agents_per_age_group = population.agents_per_age_group
+
+        num_age_groups = len(config.age_groups)
+        self.age_group_index = population.age_group_index
+        # Age group of each agent numbered across replicates, replicate * number of age groups + age group
+        self.replicate_age_group_index = \
+            np.repeat(np.arange(num_replicates) * num_age_groups, num_agents) + self.age_group_index
+        self.age = population.age
+        self.state = population.state
+        self.viralload = population.viralload
+        num_agents = num_agents * num_replicates
+
+        self.immunosenescence_factor = population.immunosenescence_factor
+        self.death_rate = population.death_rate
+        self.threshold1, self.threshold2, self.threshold3, self.threshold4 = population.thresholds
+
+        self.days_exposed = np.zeros(num_agents, dtype=np.int64)
+        self.days_infected = np.zeros(num_agents, dtype=np.int64)
+        self.falling_viral_load = np.zeros(num_agents, dtype=bool)
+        self.is_dead = np.zeros(num_agents, dtype=bool)
+
+        # Active set: the sorted indices of the agents whose update can change anything, i.e. exposed and
+        # infected agents and every agent with a nonzero viral load. The update of any other agent (S, R or D
+        # with no viral load) is a no-op, so those agents are skipped. Their loads are zero, so they add
+        # nothing to the viral load sums, and the (age group, state) counts are kept up to date incrementally.
+        self.num_codes = num_replicates * num_age_groups * len(state_names)
+        self.active = np.flatnonzero((self.state == E_STATE) | (self.state == I_STATE) | (self.viralload > 0))
+        self.counts_by_code = np.bincount(self.codes(), minlength=self.num_codes)
+
+    def codes(self, agents=slice(None)):
+        # Combined (age group, state) code of the agents, as in tally_states, numbered across replicates
+        return self.replicate_age_group_index[agents] * len(state_names) + self.state[agents]
+
+    def update_active_set(self, receivers):
+        # Drop agents that went quiet this step and add the susceptible agents that received viral load
+        active = self.active
+        still_active = (self.state[active] == E_STATE) | (self.state[active] == I_STATE) | (self.viralload[active] > 0)
+        self.active = np.union1d(active[still_active], receivers)
+
+    def is_extinct(self):
+        # Every susceptible agent in the active set holds viral load, so is_extinct() reduces to this
+        active_state = self.state[self.active]
+        return not np.any((active_state == E_STATE) | (active_state == I_STATE) | (active_state == S_STATE))
+
+    def tally_counts(self, agents=None, viralload=None):
+        # (age group, state) counts and viral load sums of each replicate, shape (replicates, age groups, states).
+        # The load sums are taken over the active set unless other agents and loads are given.
+        if agents is None:
+            agents = self.active
+        if viralload is None:
+            viralload = self.viralload
+        load_sums = np.bincount(self.codes(agents), weights=viralload[agents], minlength=self.num_codes)
+        shape = (self.num_replicates, len(self.config.age_groups), len(state_names))
+        return self.counts_by_code.reshape(shape), load_sums.reshape(shape)
+
+    def tally(self):
+        # tally_states over the active set only
+        counts_by_age, load_sums_by_age = self.tally_counts()
+        return summarize_tallies(counts_by_age[0], load_sums_by_age[0])
+
+    def update_states(self, deaths_by_ages, rng):
+        # Vectorized Agent.update_state over the active set: every agent takes the branch of the state it held at
+        # the start of the step. The active set is sorted, so every branch sees its agents in the same order, and
+        # draws the same random numbers, as it would over the whole population.
+        state = self.state
+        viralload = self.viralload
+        active = self.active
+        active_state = state[active]
+        codes_before = self.codes(active)
+        susceptible = active[active_state == S_STATE]
+        exposed = active[active_state == E_STATE]
+        infected = active[active_state == I_STATE]
+        recovered = active[active_state == R_STATE]
+        dead = active[active_state == D_STATE]
+
+        # Susceptible agents become exposed once their accumulated viral load passes threshold 1
+        self.days_infected[susceptible] = 0
+        self.days_exposed[susceptible] = 0
+        state[susceptible[viralload[susceptible] > self.threshold1[susceptible]]] = E_STATE
+
+        # Exposed agents either become infected within the latent period or recover after it
+        self.days_exposed[exposed] += 1
+        viralload[exposed] += rng.random(len(exposed)) / 5
+        within_latent_period = self.days_exposed[exposed] < self.config.latent_period
+        becomes_infected = within_latent_period & (viralload[exposed] > self.threshold2[exposed])
+        state[exposed[becomes_infected]] = I_STATE
+        self.days_infected[exposed[becomes_infected]] = 0
+        state[exposed[~becomes_infected & ~within_latent_period]] = R_STATE
+
+        # Infected agents: viral load rises until threshold 3, then falls at an age dependent rate
+        self.days_infected[infected] += 1
+        rising = infected[~self.falling_viral_load[infected]]
+        falling = infected[self.falling_viral_load[infected]]
+        viralload[rising] += rng.random(len(rising)) / 3  # Increasing viral load
+        self.falling_viral_load[rising[viralload[rising] > self.threshold3[rising]]] = True
+        viralload[falling] -= rng.random(len(falling)) * self.immunosenescence_factor[falling]  # Decreasing viral load
+        viralload[infected] = np.maximum(viralload[infected], 0)
+        # Check if agent should die based on age and death rate
+        dies = infected[rng.random(len(infected)) < self.death_rate[infected]]
+        self.is_dead[dies] = True
+        state[dies] = D_STATE
+        deaths_by_ages += np.bincount(self.replicate_age_group_index[dies], minlength=len(deaths_by_ages))
+        state[infected[viralload[infected] <= self.threshold4[infected]]] = R_STATE
+
+        viralload[dead] = 0
+
+        # Recovered agents clear any remaining viral load
+        clearing = recovered[viralload[recovered] > 0]
+        viralload[clearing] -= rng.random(len(clearing)) * self.immunosenescence_factor[clearing] / 3
+        viralload[clearing] = np.maximum(viralload[clearing], 0)
+
+        self.counts_by_code += np.bincount(self.codes(active), minlength=self.num_codes) \
+            - np.bincount(codes_before, minlength=self.num_codes)
+
+    def to_agents(self, viral_load_histories):
+        # Materialize Agent objects for callers of simulate() that expect them
+        agents = []
+        for i in range(len(self.state)):
+            agent = Agent.__new__(Agent)
+            agent.config = self.config
+            agent.state = state_names[self.state[i]]
+            agent.days_exposed = int(self.days_exposed[i])
+            agent.days_infected = int(self.days_infected[i])
+            agent.viralload = float(self.viralload[i])
+            agent.immune_days = 0
+            agent.age = int(self.age[i])
+            agent.is_dead = bool(self.is_dead[i])
+            agent.age_group_index = int(self.age_group_index[i])
+            agent.immunosenescence_factor = float(self.immunosenescence_factor[i])
+            agent.threshold1 = float(self.threshold1[i])
+            agent.threshold2 = float(self.threshold2[i])
+            agent.threshold3 = float(self.threshold3[i])
+            agent.threshold4 = float(self.threshold4[i])
+            agent.viral_load_history = viral_load_histories[i]
+            agent.falling_viral_load = bool(self.falling_viral_load[i])
+            agents.append(agent)
+        return agents
+
+
+# Vectorized simulation engine: same model and return values as simulate(), with the agent
+# population held in NumPy arrays so that each time step is a fixed number of array operations
+def simulate_vectorized(simulation_number, rng=None, compact=False, config=None):
+    config = resolve_config(config)
+    profiler = start_profiler(config)
+    if rng is None:
+        rng = np.random.default_rng()
+    population = AgentArrays(config.num_agents, rng, config)
+    deaths_by_ages = np.zeros(len(config.death_rates), dtype=np.int64)
+    agents_in_age_group = [np.flatnonzero(population.age_group_index == index)
+                           for index in range(len(config.age_groups))]
+
+    state_counts = []
+    state_counts.append([config.num_agents-(config.num_infected+config.num_exposed), config.num_exposed,
+                         config.num_infected, 0, 0])
+    state_dynamics_by_age = {age_group: [] for age_group in config.age_groups}
+    avg_viral_loads = []
+    avg_viral_loads_by_age = [[] for _ in range(len(config.age_groups))]
+    max_viral_loads_by_age = np.zeros(len(config.age_groups))
+    record_trajectories = config.record_trajectories or not compact
+    trajectory = TrajectoryRecorder(population.age_group_index, config=config,
+                                    age_group_selection=None if record_trajectories else [])
+    trajectory.record(0, population.viralload)
+    kinetics = InfectionKinetics(population.age_group_index, population.state, population.viralload)
+    events = EventLog()
+    # Viral load after the state update and before contacts, which is what Agent.viral_load_history records
+    if record_trajectories:
+        viral_load_after_update = np.zeros((config.num_agents, config.time_steps))
+
+    contact_sampler = ContactSampler(population.age_group_index, config.social_interaction_matrix)
+    contacts_per_step = round(config.contacts_per_agent * config.num_agents)
+    if profiler:
+        profiler.lap('setup')
+
+    for t in range(config.time_steps):
+        # Only agents in the active set change state
+        if config.record_events:
+            state_before = population.state[population.active]
+        population.update_states(deaths_by_ages, rng)
+        viralload = population.viralload
+        state = population.state
+        active = population.active
+        # Agents outside the active set have no viral load, so their entries stay zero
+        if record_trajectories:
+            viral_load_after_update[active, t] = viralload[active]
+        if profiler:
+            profiler.lap('agent_updates')
+        kinetics.update(t + 1, state, viralload, active)
+        if config.record_events:
+            events.record_changes(t + 1, active, state_before, state, viralload)
+        if profiler:
+            profiler.lap('kinetics')
+        np.maximum.at(max_viral_loads_by_age, population.age_group_index[active], viralload[active])
+        if profiler:
+            profiler.lap('max_load_tracking')
+
+        agent1_indices, agent2_indices = contact_sampler.sample(contacts_per_step, rng)
+        receivers = transmit_viral_load(state, viralload, agent1_indices, agent2_indices)
+        population.update_active_set(receivers)
+        if profiler:
+            profiler.lap('contacts')
+
+        # Record state counts, state dynamics and average viral loads by age group
+        state_count, state_count_by_age, avg_viral_load, avg_viral_load_by_age = population.tally()
+        state_counts.append(state_count)
+        if profiler:
+            profiler.lap('state_tallies')
+        for age_group_index, age_group in enumerate(config.age_groups):
+            state_dynamics_by_age[age_group].append(state_count_by_age[age_group_index])
+            avg_viral_loads_by_age[age_group_index].append(avg_viral_load_by_age[age_group_index])
+        avg_viral_loads.append(avg_viral_load)
+        if profiler:
+            profiler.lap('age_averages')
+
+        # Agents that left the active set this step have a zero load, which the buffer already holds
+        trajectory.record_agents(t + 1, np.union1d(active, population.active), viralload)
+        if profiler:
+            profiler.lap('recording')
+
+        if config.stop_at_extinction and t + 1 < config.time_steps and population.is_extinct():
+            loads = decay_after_extinction(state, viralload, population.immunosenescence_factor,
+                                           config.time_steps - t - 1, rng)
+            record_extinct_steps(t + 1, state, population.age_group_index, loads, config, state_counts,
+                                 state_dynamics_by_age, avg_viral_loads, avg_viral_loads_by_age, trajectory)
+            if record_trajectories:
+                viral_load_after_update[:, t + 1:] = loads
+            kinetics.add_loads(t + 2, loads)
+            population.viralload[:] = loads[:, -1]
+            if profiler:
+                profiler.lap('extinction_fill')
+            break
+
+    if record_trajectories:
+        histories = ragged_histories(viral_load_after_update, population.age_group_index, len(config.age_groups))
+
+    if config.verbose:
+        print_simulation_report(simulation_number, config, population.agents_per_age_group, deaths_by_ages,
+                                max_viral_loads_by_age)
+
+    if compact:
+        result = {
+            'state_counts': np.array(state_counts),
+            'avg_viral_loads': np.array(avg_viral_loads),
+            'state_dynamics_by_age': np.array([state_dynamics_by_age[age_group] for age_group in config.age_groups]),
+            'avg_viral_loads_by_age': np.array(avg_viral_loads_by_age),
+            'viral_load_data': trajectory.data[:, 1:],
+            'viral_load_data_agents': trajectory.agents,
+            'viral_load_data_steps': trajectory.steps[1:],
+            'days_exposed': population.days_exposed,
+            'days_infected': population.days_infected,
+            'ages': population.age,
+            'age_group_index': population.age_group_index,
+            'kinetics': kinetics.table(population.days_exposed, population.days_infected),
+        }
+        if record_trajectories:
+            result['viral_load_history_values'] = histories.values
+            result['viral_load_history_offsets'] = histories.offsets
+        if config.record_events:
+            result['events'] = events.events()
+            result['deaths_by_age'] = deaths_by_ages
+        if profiler:
+            result['phase_profile'] = profiler.as_dict()
+        return result
+
+    agents = population.to_agents(histories.to_lists())
+    viral_load_data_by_age = [viral_load_after_update[members].T.ravel() for members in agents_in_age_group]
+    days_exposed = population.days_exposed.tolist()
+    days_infected = population.days_infected.tolist()
+    viral_load_data = trajectory.data[:, 1:]
+    viral_load_data_by_age_and_time = [trajectory.by_age_group(age_group_index)[:, 1:].T
+                                       for age_group_index in range(len(config.age_groups))]
     return state_counts, agents, avg_viral_loads, state_dynamics_by_age, avg_viral_loads_by_age, viral_load_data_by_age, \
             viral_load_data, viral_load_data_by_age_and_time, days_exposed, days_infected
 
+
+# Batched simulation engine: advances len(simulation_numbers) independent replicates together, with the agents of
+# all replicates in the flat arrays of one AgentArrays. Every step is a fixed number of array operations for the
+# whole batch: one state update, one batched contact draw and one bincount for the tallies of all replicates.
+# Returns one compact result per replicate, as simulate_vectorized(..., compact=True) does. Memory grows with the
+# batch size (the pre-contact viral load history is num_agents x time_steps per replicate), so large ensembles are
+# run as several batches, e.g. by run_simulations_in_parallel(engine='batched').
+def simulate_batch(simulation_numbers, rng=None, config=None):
+    config = resolve_config(config)
+    profiler = start_profiler(config)
+    if rng is None:
+        rng = np.random.default_rng()
+    num_replicates = len(simulation_numbers)
+    num_agents = config.num_agents
+    num_age_groups = len(config.age_groups)
+    population = AgentArrays(num_agents, rng, config, num_replicates)
+    deaths_by_ages = np.zeros(num_replicates * num_age_groups, dtype=np.int64)
+    age_group_index = population.age_group_index[:num_agents]
+
+    state_counts = np.zeros((num_replicates, config.time_steps + 1, len(state_names)), dtype=np.int64)
+    state_counts[:, 0] = [num_agents-(config.num_infected+config.num_exposed), config.num_exposed, config.num_infected,
+                          0, 0]
+    state_dynamics_by_age = np.zeros((num_replicates, num_age_groups, config.time_steps, len(state_names)),
+                                     dtype=np.int64)
+    avg_viral_loads = np.zeros((num_replicates, config.time_steps))
+    avg_viral_loads_by_age = np.zeros((num_replicates, num_age_groups, config.time_steps))
+    max_viral_loads_by_age = np.zeros(num_replicates * num_age_groups)
+    # The recorder only picks the recorded agents and steps; the loads of all replicates go to one buffer
+    recorder = TrajectoryRecorder(age_group_index, config=config,
+                                  age_group_selection=None if config.record_trajectories else [])
+    trajectory = np.zeros((num_replicates, len(recorder.agents), len(recorder.steps)), dtype=recorder.data.dtype)
+    trajectory[:, :, 0] = population.viralload.reshape(num_replicates, num_agents)[:, recorder.agents]
+    kinetics = InfectionKinetics(population.age_group_index, population.state, population.viralload)
+    # One log for the batch, with agents numbered across replicates
+    events = EventLog()
+    if config.record_trajectories:
+        viral_load_after_update = np.zeros((num_replicates * num_agents, config.time_steps))
+
+    contact_sampler = ContactSampler(age_group_index, config.social_interaction_matrix)
+    contacts_per_step = round(config.contacts_per_agent * num_agents)
+
+    def record_step(t, counts_by_age, load_sums_by_age):
+        # Tallies at the end of time step t for all replicates
+        state_count, avg_viral_load, avg_viral_load_by_age = tally_arrays(counts_by_age, load_sums_by_age)
+        state_counts[:, t + 1] = state_count
+        state_dynamics_by_age[:, :, t] = counts_by_age
+        avg_viral_loads[:, t] = avg_viral_load
+        avg_viral_loads_by_age[:, :, t] = avg_viral_load_by_age
+
+    def record_trajectory(t, viralload):
+        # Trajectory column at the end of time step t for all replicates
+        if (t + 1) % recorder.every == 0:
+            trajectory[:, :, (t + 1) // recorder.every] = \
+                viralload.reshape(num_replicates, num_agents)[:, recorder.agents]
+
+    if profiler:
+        profiler.lap('setup')
+
+    for t in range(config.time_steps):
+        if config.record_events:
+            state_before = population.state[population.active]
+        population.update_states(deaths_by_ages, rng)
+        viralload = population.viralload
+        state = population.state
+        active = population.active
+        if config.record_trajectories:
+            viral_load_after_update[active, t] = viralload[active]
+        if profiler:
+            profiler.lap('agent_updates')
+        kinetics.update(t + 1, state, viralload, active)
+        if config.record_events:
+            events.record_changes(t + 1, active, state_before, state, viralload)
+        if profiler:
+            profiler.lap('kinetics')
+        np.maximum.at(max_viral_loads_by_age, population.replicate_age_group_index[active], viralload[active])
+        if profiler:
+            profiler.lap('max_load_tracking')
+
+        agent1_indices, agent2_indices = contact_sampler.sample_batch(num_replicates, contacts_per_step, rng)
+        receivers = transmit_viral_load(state, viralload, agent1_indices, agent2_indices)
+        population.update_active_set(receivers)
+        if profiler:
+            profiler.lap('contacts')
+
+        counts_by_age, load_sums_by_age = population.tally_counts()
+        record_step(t, counts_by_age, load_sums_by_age)
+        if profiler:
+            profiler.lap('state_tallies')
+        record_trajectory(t, viralload)
+        if profiler:
+            profiler.lap('recording')
+
+        # The batch is only cut short once every replicate has gone extinct
+        if config.stop_at_extinction and t + 1 < config.time_steps and population.is_extinct():
+            loads = decay_after_extinction(state, viralload, population.immunosenescence_factor,
+                                           config.time_steps - t - 1, rng)
+            everyone = np.arange(len(viralload))
+            for step in range(loads.shape[1]):
+                record_step(t + 1 + step, *population.tally_counts(everyone, loads[:, step]))
+                record_trajectory(t + 1 + step, loads[:, step])
+            if config.record_trajectories:
+                viral_load_after_update[:, t + 1:] = loads
+            kinetics.add_loads(t + 2, loads)
+            population.viralload[:] = loads[:, -1]
+            if profiler:
+                profiler.lap('extinction_fill')
+            break
+
+    max_viral_loads_by_age = max_viral_loads_by_age.reshape(num_replicates, num_age_groups)
+    deaths_by_ages = deaths_by_ages.reshape(num_replicates, num_age_groups)
+    if config.record_events:
+        # Split the log by replicate, keeping the day order, and number the agents within their replicate
+        event_replicate = events.events()['agent'] // num_agents
+        batch_events = events.events()[np.argsort(event_replicate, kind='stable')]
+        batch_events['agent'] %= num_agents
+        event_offsets = np.concatenate(([0], np.cumsum(np.bincount(event_replicate, minlength=num_replicates))))
+    results = []
+    for replicate, simulation_number in enumerate(simulation_numbers):
+        agents = slice(replicate * num_agents, (replicate + 1) * num_agents)
+        if config.record_trajectories:
+            histories = ragged_histories(viral_load_after_update[agents], age_group_index, num_age_groups)
+        if config.verbose:
+            print_simulation_report(simulation_number, config, population.agents_per_age_group,
+                                    deaths_by_ages[replicate], max_viral_loads_by_age[replicate])
+
+        result = {
+            'state_counts': state_counts[replicate],
+            'avg_viral_loads': avg_viral_loads[replicate],
+            'state_dynamics_by_age': state_dynamics_by_age[replicate],
+            'avg_viral_loads_by_age': avg_viral_loads_by_age[replicate],
+            'viral_load_data': trajectory[replicate, :, 1:],
+            'viral_load_data_agents': recorder.agents,
+            'viral_load_data_steps': recorder.steps[1:],
+            'days_exposed': population.days_exposed[agents],
+            'days_infected': population.days_infected[agents],
+            'ages': population.age[agents],
+            'age_group_index': age_group_index,
+            'kinetics': kinetics.table(population.days_exposed, population.days_infected, agents),
+        }
+        if config.record_trajectories:
+            result['viral_load_history_values'] = histories.values
+            result['viral_load_history_offsets'] = histories.offsets
+        if config.record_events:
+            result['events'] = batch_events[event_offsets[replicate]:event_offsets[replicate + 1]]
+            result['deaths_by_age'] = deaths_by_ages[replicate]
+        results.append(result)
+    if profiler:
+        # One profile for the whole batch, counted once per replicate
+        profiler.replicates = num_replicates
+        results[0]['phase_profile'] = profiler.as_dict()
+    return results
+
+
+# Simulation engines selectable in run_simulations_in_parallel. Batch engines run a whole chunk of simulations
+# in one call.
+simulation_engines = {'agent': simulate, 'vectorized': simulate_vectorized}
+batch_engines = {'batched': simulate_batch}
+
 # # Run simulation
 # state_counts, agents, avg_viral_loads, viral_load_data_by_agent = simulate()
 # state_counts = np.array(state_counts)
@@ -360,161 +1486,681 @@ def simulate(simulation_number):
 # r_counts = state_counts[:, 3]
 # d_counts = state_counts[:, 4]
 
-start_time_script = time.time()
-
-def run_simulations_in_parallel(num_simulations):
-    # Run simulation n times and accumulate results
-   # num_simulations = 2
-    avg_state_counts = np.zeros((time_steps+1, 5))  # Initialize an array to accumulate state counts
-    overall_avg_loads = []
-    avg_state_dynamics_by_age = {age_group: [] for age_group in age_groups}
-    avg_viral_load_by_age = [[] for _ in range(len(age_groups))]
-    overall_avg_loads_by_age = []
-    viral_load_histories_by_age = [[] for _ in range(len(age_groups))]
-    simulation_data_by_age_group = {age_group: [] for age_group in age_groups}
-    all_viral_load_data = []
-    all_age_viral_load_data = [[] for _ in age_groups]
-    viral_load_data_by_age_and_time_accum = {age_group: [] for age_group in age_groups}
-    all_days_in_exposed_state = []
-    all_days_in_infected_state = []
-    all_ages = []
-
-
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(simulate, simulation) for simulation in range(num_simulations)]
-        for future in concurrent.futures.as_completed(futures):
-            state_counts, agents, avg_viral_loads, state_dynamics_by_age, avg_viral_loads_by_age, viral_load_data_by_age, \
-                viral_load_data, viral_load_data_by_age_and_time, days_exposed, days_infected = future.result()
-
-            # Append viral load data for this simulation to the list
-            all_viral_load_data.append(viral_load_data)
-            all_days_in_exposed_state.append(days_exposed)
-            all_days_in_infected_state.append(days_infected)
-            all_ages.extend([agent.get_age() for agent in agents])
-
-            for agent in agents:
-                age_group_index = age_groups.index( age_groups[agent.age_group_index])
-                viral_load_histories_by_age[age_group_index].append(agent.viral_load_history)
-
-            avg_state_counts += np.array(state_counts)
-            # Store the average viral loads and profiles at each time step for this simulation
-            overall_avg_loads.append(avg_viral_loads)
-            for age_group in age_groups:
-                age_group_index = age_groups.index(age_group)
-                overall_avg_loads_by_age.append(avg_viral_loads_by_age)
-                simulation_data_by_age_group[age_group].append(avg_viral_loads_by_age[age_group_index])
-                avg_state_dynamics_by_age[age_group].append(np.array(state_dynamics_by_age[age_group]))
-                viral_load_data_by_age_and_time_accum[age_group].append(viral_load_data_by_age_and_time[age_group_index])
-
-    return all_days_in_exposed_state, all_days_in_infected_state, all_viral_load_data, viral_load_data_by_age_and_time_accum, \
-    simulation_data_by_age_group, overall_avg_loads, overall_avg_loads_by_age, avg_state_dynamics_by_age, \
-    viral_load_histories_by_age, avg_state_counts, all_ages, agents
-
-
-num_simulations = 1000
-all_days_in_exposed_state, all_days_in_infected_state, all_viral_load_data, viral_load_data_by_age_and_time_accum, \
-    simulation_data_by_age_group, overall_avg_loads, overall_avg_loads_by_age, avg_state_dynamics_by_age, \
-    viral_load_histories_by_age, avg_state_counts, all_ages, agents = run_simulations_in_parallel(num_simulations)
-
-# print(overall_viral_load_data_by_age_and_time.shape)  # Should print (num_age_groups, num_agents, time_steps)
-# Calculate the average viral load data over all simulations
-overall_viral_load_data = np.mean(all_viral_load_data, axis=0)
-# all_age_viral_load_data = np.mean(all_age_viral_load_data, axis=0)
-
-# Convert days exposed and infected to numpy array and compute average
-all_days_in_exposed_state = np.array(all_days_in_exposed_state)
-all_days_in_infected_state = np.array(all_days_in_infected_state)
-avg_days_in_exposed_state = np.mean(all_days_in_exposed_state, axis=0)
-avg_days_in_infected_state = np.mean(all_days_in_infected_state, axis=0)
-
-# Create a directory to store overall viral load data
-ovrall_viral_load_dir = os.path.join(primary_directory, "Viral_Load_Data")
-if not os.path.exists(ovrall_viral_load_dir):
-    os.mkdir(ovrall_viral_load_dir)
-# Save the overall viral load data to a CSV file
-ovrall_viral_load_file_path = os.path.join(ovrall_viral_load_dir, 'overall_viral_load.csv')
-with open(ovrall_viral_load_file_path, 'w', newline='') as file:
-    writer = csv.writer(file)
-    for agent_loads in overall_viral_load_data:
-        writer.writerow(agent_loads)
-
-# Average viral load data by age and time for all simulations
-for age_group in age_groups:
-    avg_viral_load_data_by_age_and_time = np.mean(viral_load_data_by_age_and_time_accum[age_group], axis=0)
-    transposed_data = np.transpose(avg_viral_load_data_by_age_and_time)
-    # Save the transposed data to a CSV file for each age group
-    age_group_file_path = os.path.join(ovrall_viral_load_dir, f'viral_load_data_by_age_and_time_{age_group}.csv')
-    np.savetxt(age_group_file_path, transposed_data, delimiter=',', fmt='%0.4f')
-
-# Create a directory to store age group-specific data
-viral_load_data_dir = os.path.join(primary_directory, "Simulation_stat_analysis_data")
-if not os.path.exists(viral_load_data_dir):
-    os.mkdir(viral_load_data_dir)
-# Overall average viral load data to a CSV file in the same directory as age group data
-overall_avg_file_path = os.path.join(viral_load_data_dir, "overall_avg_viral_load.csv")
-with open(overall_avg_file_path, 'w', newline='') as overall_file:
-    writer = csv.writer(overall_file)
-    writer.writerows(overall_avg_loads)
-# Write the data for each age group to separate CSV files
-for age_group_index, age_group in enumerate(age_groups):
-    age_group_file_path = os.path.join(viral_load_data_dir, f'overall_avg_viral_load_age_{age_group}.csv')
-    age_group_data = np.array(simulation_data_by_age_group[age_group], dtype=float)
-    with open(age_group_file_path, 'w', newline='') as age_file:
-        writer = csv.writer(age_file, delimiter=',')
-        # header_row = [str(i) for i in range(age_group_data.shape[1])]
-        # writer.writerow(header_row)
-        writer.writerows(age_group_data)
-
-# Calculate the overall average viral load at each time step across all simulations
-overall_avg_viral_loads = np.mean(np.array(overall_avg_loads), axis=0)
-for age_group in age_groups:
-    overall_avg_viral_loads_by_age = np.mean(np.array(overall_avg_loads_by_age), axis=0)
-
-# Calculate the average state dynamics by age
-for age_group in age_groups:
-    avg_state_dynamics_by_age[age_group] = np.mean(np.array(avg_state_dynamics_by_age[age_group]), axis=0)
-
-avg_viral_load_profiles_by_age = []
-for age_group_histories in viral_load_histories_by_age:
-    max_history_length = max(len(history) for history in age_group_histories)
-    age_group_histories_padded = np.array(
-        [history + [0] * (max_history_length - len(history)) for history in age_group_histories]
-    )
-    avg_viral_load_profile_by_age_group = np.nanmean(age_group_histories_padded, axis=0)
-    avg_viral_load_profiles_by_age.append(avg_viral_load_profile_by_age_group)
-
-
-# Calculate the total time taken for the entire script
-end_time_script = time.time()
-total_time_script = end_time_script - start_time_script
-print(f"Total time taken for the entire script: {total_time_script} seconds")
-
-print("\nAgent Information:")
-print("{:<10} {:<15} {:<15} {:<5}".format("Agent ID", "Days Exposed", "Days Infected", "Age"))
-average_infected = 0
-agents_not_infected = 0
-for i, agent in enumerate(agents):
-    print("{:<10} {:<15} {:<15} {:<5}".format(i + 1, agent.days_exposed, agent.days_infected, agent.age))
-    average_infected += agent.days_infected
-    if agent.days_infected == 0:
-            agents_not_infected += 1
-print("average days infected", average_infected/(500-agents_not_infected))
-
-avg_state_counts = avg_state_counts/num_simulations
-# Extract individual state counts for plotting
-s_counts = avg_state_counts[:, 0]
-e_counts = avg_state_counts[:, 1]
-i_counts = avg_state_counts[:, 2]
-r_counts = avg_state_counts[:, 3]
-d_counts = avg_state_counts[:, 4]
-
-
-def plotting_function():
+# Compact NumPy form of one simulation result. Worker processes return this instead of lists of Agent objects.
+# The viral load histories of all agents are stored back to back in one array, with agent i's history in
+# viral_load_history_values[viral_load_history_offsets[i]:viral_load_history_offsets[i + 1]], taken from the
+# agents' lists unless the engine passes its RaggedHistories. Row j of viral_load_data is agent
+# viral_load_data_agents[j] and its columns are the time steps in viral_load_data_steps.
+def compact_result(state_counts, agents, avg_viral_loads, state_dynamics_by_age, avg_viral_loads_by_age,
+                   trajectory, days_exposed, days_infected, config=None, histories=None):
+    config = resolve_config(config)
+    if histories is None and config.record_trajectories:
+        history_lengths = [len(agent.viral_load_history) for agent in agents]
+        histories = RaggedHistories(np.array([load for agent in agents for load in agent.viral_load_history]),
+                                    np.concatenate(([0], np.cumsum(history_lengths))),
+                                    [agent.age_group_index for agent in agents], len(config.age_groups))
+    result = {
+        'state_counts': np.array(state_counts),
+        'avg_viral_loads': np.array(avg_viral_loads),
+        'state_dynamics_by_age': np.array([state_dynamics_by_age[age_group] for age_group in config.age_groups]),
+        'avg_viral_loads_by_age': np.array(avg_viral_loads_by_age),
+        'viral_load_data': trajectory.data[:, 1:],
+        'viral_load_data_agents': trajectory.agents,
+        'viral_load_data_steps': trajectory.steps[1:],
+        'days_exposed': np.array(days_exposed),
+        'days_infected': np.array(days_infected),
+        'ages': np.array([agent.age for agent in agents]),
+        'age_group_index': np.array([agent.age_group_index for agent in agents]),
+    }
+    if config.record_trajectories:
+        result['viral_load_history_values'] = histories.values
+        result['viral_load_history_offsets'] = histories.offsets
+    return result
+
+
+# Generator of one replicate, or of one batch of replicates, spawned from the master seed. Replicate n gets child n
+# of SeedSequence(seed), the same stream as SeedSequence(seed).spawn(n + 1)[n], so it depends neither on the worker
+# that runs it nor on the other replicates. A batch of replicates shares one child of its first replicate's sequence,
+# keyed by the batch length. Without a seed the Generator is seeded from fresh entropy.
+def replicate_rng(seed, simulation_numbers):
+    if seed is None:
+        return np.random.default_rng()
+    spawn_key = (simulation_numbers[0],)
+    if len(simulation_numbers) > 1:
+        spawn_key += (len(simulation_numbers),)
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=spawn_key))
+
+
+# Fields of the compact results of config that have the same shape in every replicate, as {name: (shape, dtype)},
+# and the fields that are the same in every replicate, as {name: value}. Without per_agent these are only the
+# per-step tallies. Viral load histories are ragged; their values get a row of num_agents * time_steps, as an agent
+# adds at most one value per time step.
+def result_arena_layout(config, per_agent=False):
+    num_agents, num_age_groups = config.num_agents, len(config.age_groups)
+    layout = {
+        'state_counts': ((config.time_steps + 1, len(state_names)), np.int64),
+        'avg_viral_loads': ((config.time_steps,), np.float64),
+        'state_dynamics_by_age': ((num_age_groups, config.time_steps, len(state_names)), np.int64),
+        'avg_viral_loads_by_age': ((num_age_groups, config.time_steps), np.float64),
+    }
+    if not per_agent:
+        return layout, {}
+    _, age_group_index, _, _ = population_layout(config)
+    trajectory = TrajectoryRecorder(age_group_index, config=config,
+                                    age_group_selection=None if config.record_trajectories else [])
+    layout.update({
+        'viral_load_data': ((len(trajectory.agents), len(trajectory.steps) - 1), trajectory.data.dtype),
+        'days_exposed': ((num_agents,), np.int64),
+        'days_infected': ((num_agents,), np.int64),
+        'ages': ((num_agents,), np.int64),
+        'age_group_index': ((num_agents,), np.int64),
+        'kinetics': ((num_agents,), kinetics_dtype),
+    })
+    if config.record_trajectories:
+        layout['viral_load_history_values'] = ((num_agents * config.time_steps,), np.float64)
+        layout['viral_load_history_offsets'] = ((num_agents + 1,), np.int64)
+    constants = {'viral_load_data_agents': trajectory.agents, 'viral_load_data_steps': trajectory.steps[1:]}
+    return layout, constants
+
+
+# Result arena of an ensemble run in worker processes: one preallocated, memory-mapped array of shape
+# (num_simulations, ...) in the result store in directory for every field of result_arena_layout(), with the
+# per-agent fields if per_agent (arena_per_agent by default). A worker writes
+# each replicate it finishes straight into its row and sends back only the rest of the result, such as the event
+# log. The parent then folds the replicate from views of its rows, without copying or unpickling them.
+class ResultArena:
+    def __init__(self, directory, config, num_simulations, first_simulation=0, per_agent=None):
+        self.directory = directory
+        self.first_simulation = first_simulation
+        per_agent = arena_per_agent if per_agent is None else per_agent
+        self.layout, self.constants = result_arena_layout(config, per_agent)
+        self.arrays = {name: VL_result_store.create_result(directory, name, (num_simulations,) + shape, dtype,
+                                                           metadata={'first_simulation': first_simulation})
+                       for name, (shape, dtype) in self.layout.items()}
+
+    # Workers get the arena without its arrays and map them again on first use
+    def __getstate__(self):
+        return dict(self.__dict__, arrays=None)
+
+    def open(self):
+        if self.arrays is None:
+            self.arrays = {name: VL_result_store.load_result(self.directory, name, mmap_mode='r+')
+                           for name in self.layout}
+        return self.arrays
+
+    def write(self, result):
+        # Store the arena fields of result in the row of its simulation and return the rest of it
+        row = result['simulation_number'] - self.first_simulation
+        arrays = self.open()
+        for name, value in result.items():
+            if name not in arrays:
+                continue
+            if name == 'viral_load_history_values':
+                arrays[name][row, :len(value)] = value
+            else:
+                arrays[name][row] = value
+        return {name: value for name, value in result.items() if name not in arrays and name not in self.constants}
+
+    def read(self, remainder):
+        # The whole result again, its arena fields as views of their rows
+        row = remainder['simulation_number'] - self.first_simulation
+        arrays = self.open()
+        result = dict(self.constants)
+        result.update((name, array[row]) for name, array in arrays.items())
+        if 'viral_load_history_values' in result:
+            result['viral_load_history_values'] = result['viral_load_history_values'][
+                :result['viral_load_history_offsets'][-1]]
+        result.update(remainder)
+        return result
+
+    def close(self):
+        self.arrays = None
+
+
+# Worker tasks for the pools: run one simulation, or a chunk of simulations, and return compact results
+def simulate_chunk_item(simulation_number, engine='agent', config=None, seed=None):
+    rng = replicate_rng(seed, [simulation_number])
+    if engine in batch_engines:
+        return batch_engines[engine]([simulation_number], rng=rng, config=config)[0]
+    return simulation_engines[engine](simulation_number, rng=rng, compact=True, config=config)
+
+
+# With an arena the results are written into it, and only what does not fit its layout is returned
+def simulate_chunk(simulation_numbers, engine='agent', config=None, seed=None, arena=None):
+    if engine in batch_engines:
+        results = batch_engines[engine](simulation_numbers, rng=replicate_rng(seed, simulation_numbers), config=config)
+    else:
+        results = [simulate_chunk_item(simulation_number, engine, config, seed)
+                   for simulation_number in simulation_numbers]
+    for simulation_number, result in zip(simulation_numbers, results):
+        result['simulation_number'] = simulation_number
+    if arena is not None:
+        results = [arena.write(result) for result in results]
+    return results
+
+
+# Running mean and variance of an array-valued quantity over replicates (Welford's online algorithm)
+class RunningStatistics:
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, value):
+        value = np.asarray(value, dtype=float)
+        if self.mean is None:
+            self.mean = np.zeros_like(value)
+            self.m2 = np.zeros_like(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        # Population variance, as np.var computes it over the replicates
+        return self.m2 / self.count
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def confidence_half_width(self, z=1.645):
+        # Half-width of the confidence interval of the mean, std / sqrt(n) as in VL_statistical_analysis
+        # (z = 1.645 for the 90% interval used there)
+        return z * self.std() / np.sqrt(self.count)
+
+
+# Folds each finished replicate into fixed-size accumulators and then discards it, so memory does not grow with
+# the number of simulations. Viral load histories are summed by position per age group; dividing by the number of
+# histories gives the same profile as averaging the zero-padded histories.
+class EnsembleAccumulator:
+    def __init__(self, config=None):
+        self.config = resolve_config(config)
+        self.num_simulations = 0
+        self.state_counts = RunningStatistics()
+        self.avg_viral_loads = RunningStatistics()
+        self.avg_viral_loads_by_age = RunningStatistics()
+        self.state_dynamics_by_age = RunningStatistics()
+        self.viral_load_data = RunningStatistics()
+        self.days_exposed = RunningStatistics()
+        self.days_infected = RunningStatistics()
+        # Number of agents of each age over all replicates, from 0 to the highest age of any age group
+        self.age_counts = np.zeros(age_group_bounds(tuple(self.config.age_groups))[:, 1].max() + 1, dtype=np.int64)
+        self.age_group_index = None
+        self.viral_load_data_age_group_index = None
+        self.viral_load_data_steps = None
+        num_age_groups = len(self.config.age_groups)
+        self.viral_load_history_sums = np.zeros((num_age_groups, self.config.time_steps))
+        self.viral_load_history_counts = np.zeros(num_age_groups, dtype=np.int64)
+        self.viral_load_history_max_lengths = np.zeros(num_age_groups, dtype=np.int64)
+        self.kinetics_sums = np.zeros((num_age_groups, len(kinetics_summary_fields)))
+        self.kinetics_counts = np.zeros(num_age_groups, dtype=np.int64)
+        self.phase_profile = None
+        self.adaptive_report = None
+        self.seed = None
+        self.last_result = None
+
+    def add(self, result):
+        self.num_simulations += 1
+        self.state_counts.add(result['state_counts'])
+        self.avg_viral_loads.add(result['avg_viral_loads'])
+        self.avg_viral_loads_by_age.add(result['avg_viral_loads_by_age'])
+        self.state_dynamics_by_age.add(result['state_dynamics_by_age'])
+        self.viral_load_data.add(result['viral_load_data'])
+        self.days_exposed.add(result['days_exposed'])
+        self.days_infected.add(result['days_infected'])
+        self.age_counts += np.bincount(result['ages'], minlength=len(self.age_counts))
+        # The population is laid out by age group in the same order in every replicate
+        self.age_group_index = result['age_group_index']
+        self.viral_load_data_age_group_index = result['age_group_index'][result['viral_load_data_agents']]
+        self.viral_load_data_steps = result['viral_load_data_steps']
+
+        if 'viral_load_history_values' in result:
+            histories = RaggedHistories(result['viral_load_history_values'], result['viral_load_history_offsets'],
+                                        result['age_group_index'], len(self.config.age_groups))
+            self.viral_load_history_sums += histories.position_sums(self.config.time_steps)
+            self.viral_load_history_counts += histories.agents_per_age_group()
+            np.maximum(self.viral_load_history_max_lengths, histories.max_lengths_by_age(),
+                       out=self.viral_load_history_max_lengths)
+        if 'kinetics' in result:
+            sums, counts = kinetics_sums(result['kinetics'], len(self.config.age_groups))
+            self.kinetics_sums += sums
+            self.kinetics_counts += counts
+        if 'phase_profile' in result:
+            if self.phase_profile is None:
+                self.phase_profile = PhaseProfiler()
+            self.phase_profile.merge(result['phase_profile'])
+        self.last_result = result
+
+    # RunningStatistics and plain arrays that make up the state of an accumulator, as written by save()
+    statistic_names = ['state_counts', 'avg_viral_loads', 'avg_viral_loads_by_age', 'state_dynamics_by_age',
+                       'viral_load_data', 'days_exposed', 'days_infected']
+    array_names = ['age_counts', 'age_group_index', 'viral_load_data_age_group_index', 'viral_load_data_steps',
+                   'viral_load_history_sums', 'viral_load_history_counts', 'viral_load_history_max_lengths',
+                   'kinetics_sums', 'kinetics_counts']
+
+    def save(self, directory, metadata=None):
+        # Write the accumulated state to the result store in directory, one result per array, and the counts,
+        # the phase profile, the adaptive report and the seed to accumulator.json. load() reads it back.
+        os.makedirs(directory, exist_ok=True)
+        for name in self.statistic_names:
+            statistic = getattr(self, name)
+            if statistic.mean is not None:
+                VL_result_store.save_result(directory, f'{name}_mean', statistic.mean)
+                VL_result_store.save_result(directory, f'{name}_m2', statistic.m2)
+        for name in self.array_names:
+            if getattr(self, name) is not None:
+                VL_result_store.save_result(directory, name, getattr(self, name))
+        if self.last_result is not None:
+            for name, value in self.last_result.items():
+                if name != 'phase_profile':
+                    VL_result_store.save_result(directory, f'last_result_{name}', value)
+        state = {'num_simulations': self.num_simulations,
+                 'counts': {name: getattr(self, name).count for name in self.statistic_names},
+                 'phase_profile': self.phase_profile.as_dict() if self.phase_profile is not None else None,
+                 'adaptive_report': self.adaptive_report, 'seed': self.seed, 'metadata': metadata or {}}
+        with open(os.path.join(directory, 'accumulator.json'), 'w') as file:
+            json.dump(state, file, indent=2)
+
+    def load(self, directory):
+        # Replace the state of this accumulator with the one saved in directory, and return it
+        with open(os.path.join(directory, 'accumulator.json')) as file:
+            state = json.load(file)
+        stored = set(VL_result_store.list_results(directory))
+        self.num_simulations = state['num_simulations']
+        for name in self.statistic_names:
+            statistic = RunningStatistics()
+            statistic.count = state['counts'][name]
+            if f'{name}_mean' in stored:
+                statistic.mean = VL_result_store.load_result(directory, f'{name}_mean', mmap_mode=None)
+                statistic.m2 = VL_result_store.load_result(directory, f'{name}_m2', mmap_mode=None)
+            setattr(self, name, statistic)
+        for name in self.array_names:
+            if name in stored:
+                setattr(self, name, VL_result_store.load_result(directory, name, mmap_mode=None))
+        last_result = {name[len('last_result_'):]: VL_result_store.load_result(directory, name, mmap_mode=None)
+                       for name in sorted(stored) if name.startswith('last_result_')}
+        self.last_result = last_result or None
+        self.phase_profile = None
+        if state['phase_profile'] is not None:
+            self.phase_profile = PhaseProfiler()
+            self.phase_profile.merge(state['phase_profile'])
+        self.adaptive_report = state['adaptive_report']
+        self.seed = state.get('seed')
+        return self
+
+    def avg_viral_load_data_by_age_and_time(self, age_group_index):
+        # Average viral load of each recorded agent of the age group at each recorded time step, shape
+        # (agents, time steps). Recorded agents are sorted by age group, so this is a view.
+        rows = np.flatnonzero(self.viral_load_data_age_group_index == age_group_index)
+        if len(rows) == 0:
+            return self.viral_load_data.mean[:0]
+        return self.viral_load_data.mean[rows[0]:rows[-1] + 1]
+
+    def kinetics_by_age(self):
+        # Mean of each kinetics_summary_fields column over all infections of the ensemble, by age group (NaN for an
+        # age group without infections). outcomes and deaths become fractions of the infections, and time_to_outcome
+        # is averaged over the infections that ended.
+        infections = self.kinetics_counts[:, np.newaxis]
+        means = np.divide(self.kinetics_sums, infections, out=np.full_like(self.kinetics_sums, np.nan),
+                          where=infections > 0)
+        time_column = kinetics_summary_fields.index('time_to_outcome')
+        outcomes = self.kinetics_sums[:, kinetics_summary_fields.index('outcomes')]
+        means[:, time_column] = np.divide(self.kinetics_sums[:, time_column], outcomes,
+                                          out=np.full_like(outcomes, np.nan), where=outcomes > 0)
+        return means
+
+    def avg_viral_load_profiles_by_age(self):
+        return [self.viral_load_history_sums[age_group_index, :self.viral_load_history_max_lengths[age_group_index]]
+                / self.viral_load_history_counts[age_group_index]
+                for age_group_index in range(len(self.config.age_groups))]
+
+
+# Yield results of function(*args) for every args in task_args, in the order of task_args, so that whatever folds
+# them sees the same sequence for any number of workers. Only the max_pending tasks from the next result on are ever
+# submitted: a slow task holds back at most max_pending - 1 finished results, and finished results are folded in
+# and released instead of piling up in completed futures.
+def in_order_bounded(pool, function, task_args, max_pending):
+    task_args = list(task_args)
+    pending = {}
+    for index in range(len(task_args)):
+        for next_task in range(index + len(pending), min(index + max_pending, len(task_args))):
+            pending[next_task] = pool.submit(function, *task_args[next_task])
+        yield pending.pop(index).result()
+
+
+# Checkpoint of an ensemble run: the saved accumulator, with the completed simulation numbers, the seed and what the
+# run was in its metadata. A new checkpoint is written next to the old one and then swapped in, so that a run killed
+# while writing still has the previous checkpoint.
+def save_checkpoint(checkpoint_path, accumulator, state):
+    temporary_path = f'{checkpoint_path}.partial-{os.getpid()}'
+    previous_path = f'{checkpoint_path}.previous'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    accumulator.save(temporary_path, metadata=state)
+    if os.path.exists(checkpoint_path):
+        shutil.rmtree(previous_path, ignore_errors=True)
+        os.replace(checkpoint_path, previous_path)
+    os.replace(temporary_path, checkpoint_path)
+    shutil.rmtree(previous_path, ignore_errors=True)
+
+
+def find_checkpoint(checkpoint_path):
+    # (directory, metadata) of the checkpoint to resume from, or (None, None) if there is no checkpoint
+    for path in [checkpoint_path, f'{checkpoint_path}.previous']:
+        if os.path.exists(os.path.join(path, 'accumulator.json')):
+            with open(os.path.join(path, 'accumulator.json')) as file:
+                return path, json.load(file)['metadata']
+    return None, None
+
+
+def load_checkpoint(checkpoint_path, accumulator):
+    # Load a checkpoint into accumulator and return its metadata, or None if there is no checkpoint
+    path, state = find_checkpoint(checkpoint_path)
+    if path is not None:
+        accumulator.load(path)
+    return state
+
+
+# Run num_simulations replicates and fold them into an EnsembleAccumulator. executor='thread' runs each simulation
+# in a thread pool, executor='process' sends chunks of chunk_size simulations to max_workers worker processes (all
+# cores by default). A batch engine such as engine='batched' runs each chunk as one batch of replicates, by default
+# replicates_per_batch per chunk. replicate_callback, if given, is called with each compact result, e.g. to
+# stream it to disk. With config.profile set, the phase profiles of all replicates are summed in the accumulator's
+# phase_profile.
+# To continue an ensemble in batches, pass its accumulator, the number of the first simulation of the batch and
+# an open pool of the given executor type, which is then left open; the batch keeps the accumulator's seed.
+# Every replicate draws from its own Generator spawned from the master seed and its simulation number (see
+# replicate_rng), and results are folded in in the order of the simulation numbers, so a seeded ensemble is
+# bit-identical whatever the number of workers or the order in which they finish. Batches of a batch engine share
+# one Generator, so they are always replicates_per_batch long. Without a seed one is drawn; the accumulator keeps
+# it as its seed, and a run given that seed again is the same ensemble.
+# With a checkpoint_path the accumulator, the completed simulation numbers and the seed are saved there every
+# checkpoint_every seconds (checkpoint_interval by default) and at the end. resume=True continues from that
+# checkpoint and skips the completed replicates, which are the same ones an uninterrupted run would have simulated.
+# Worker processes return their results through a ResultArena (with use_result_arena, or whenever an
+# arena_directory is given). A given arena_directory keeps the per-replicate arrays after the run; otherwise the
+# arena is temporary. Threads share the results directly and need no arena.
+def run_simulations_in_parallel(num_simulations, engine='agent', executor='thread', max_workers=None, chunk_size=None,
+                                replicate_callback=None, config=None, accumulator=None, first_simulation=0, pool=None,
+                                seed=None, checkpoint_path=None, resume=False, checkpoint_every=None,
+                                arena_directory=None):
+    config = resolve_config(config)
+    if accumulator is None:
+        accumulator = EnsembleAccumulator(config)
+    if seed is None:
+        seed = accumulator.seed
+
+    completed = set()
+    run_description = {'config': config.result_hash(), 'engine': engine, 'num_simulations': num_simulations,
+                       'first_simulation': first_simulation}
+    checkpoint = load_checkpoint(checkpoint_path, accumulator) if checkpoint_path is not None and resume else None
+    if checkpoint is not None:
+        if {name: checkpoint[name] for name in run_description} != run_description or \
+                seed not in (None, checkpoint['seed']):
+            raise ValueError(f"The checkpoint in {checkpoint_path} is of a different run")
+        seed = checkpoint['seed']
+        chunk_size = chunk_size or checkpoint['chunk_size']
+        completed = set(checkpoint['completed'])
+    elif seed is None:
+        seed = np.random.SeedSequence().entropy
+    accumulator.seed = seed
+
+    num_workers = max_workers or os.cpu_count() or 1
+    if chunk_size is None and engine in batch_engines:
+        chunk_size = replicates_per_batch
+    elif chunk_size is None:
+        chunk_size = max(1, num_simulations // (4 * num_workers)) if executor == 'process' else 1
+    simulation_numbers = range(first_simulation, first_simulation + num_simulations)
+    chunks = [[number for number in simulation_numbers[start:start + chunk_size] if number not in completed]
+              for start in range(0, num_simulations, chunk_size)]
+    arena = None
+    temporary_arena = None
+    if executor == 'process' and (use_result_arena or arena_directory is not None):
+        if arena_directory is None:
+            arena_directory = temporary_arena = tempfile.mkdtemp(prefix='result-arena-', dir=arena_root)
+        arena = ResultArena(arena_directory, config, num_simulations, first_simulation)
+    chunks = [(chunk, engine, config, seed, arena) for chunk in chunks if chunk]
+
+    def write_checkpoint():
+        save_checkpoint(checkpoint_path, accumulator, dict(run_description, seed=seed, chunk_size=chunk_size,
+                                                           completed=sorted(completed)))
+    checkpoint_every = checkpoint_interval if checkpoint_every is None else checkpoint_every
+    last_checkpoint_time = time.time()
+
+    owns_pool = pool is None
+    if owns_pool:
+        pool_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        pool = pool_class(max_workers=max_workers)
+    try:
+        for results in in_order_bounded(pool, simulate_chunk, chunks, 2 * num_workers):
+            for result in results:
+                if arena is not None:
+                    result = arena.read(result)
+                accumulator.add(result)
+                completed.add(result['simulation_number'])
+                if replicate_callback is not None:
+                    replicate_callback(result)
+            if checkpoint_path is not None and time.time() - last_checkpoint_time >= checkpoint_every:
+                write_checkpoint()
+                last_checkpoint_time = time.time()
+        if checkpoint_path is not None:
+            write_checkpoint()
+    finally:
+        if owns_pool:
+            pool.shutdown()
+        if arena is not None:
+            # The last result outlives the arena
+            if accumulator.last_result is not None:
+                accumulator.last_result = {name: np.array(value) if isinstance(value, np.ndarray) else value
+                                           for name, value in accumulator.last_result.items()}
+            arena.close()
+        if temporary_arena is not None:
+            shutil.rmtree(temporary_arena, ignore_errors=True)
+
+    return accumulator
+
+
+# Outputs an adaptive ensemble can be run to a given precision: the RunningStatistics of the accumulator and the
+# part of it that has to be precise. Deaths are the dead agents at the last time step.
+precision_targets = {
+    'avg_viral_loads': ('avg_viral_loads', Ellipsis),
+    'avg_viral_loads_by_age': ('avg_viral_loads_by_age', Ellipsis),
+    'state_counts': ('state_counts', Ellipsis),
+    'deaths': ('state_counts', (-1, D_STATE)),
+    'deaths_by_age': ('state_dynamics_by_age', (slice(None), -1, D_STATE)),
+}
+
+
+def precision_of(accumulator, target, z=1.645, relative=False):
+    # Largest confidence interval half-width of the target over its entries, relative to the mean if asked
+    statistic_name, index = precision_targets[target]
+    statistic = getattr(accumulator, statistic_name)
+    half_width = np.atleast_1d(statistic.confidence_half_width(z)[index])
+    if relative:
+        mean = np.abs(np.atleast_1d(statistic.mean[index]))
+        half_width = np.divide(half_width, mean, out=np.zeros_like(half_width), where=mean > 0)
+    return float(half_width.max())
+
+
+# Run replicates in batches of batch_size until the confidence interval half-width of every target in targets
+# (names from precision_targets) is at most tolerance, or max_simulations replicates have run. tolerance can also be
+# a dict of target: tolerance, whose keys are then the targets. With relative=True the tolerance is a fraction of
+# the mean. At least min_simulations replicates are run so that the variance estimate is meaningful. All batches
+# draw from the one master seed. The accumulator gets an adaptive_report with the stopping rule and the precision
+# reached.
+def run_adaptive_ensemble(tolerance, targets=('avg_viral_loads_by_age',), config=None, batch_size=50,
+                          min_simulations=100, max_simulations=5000, z=1.645, relative=False, engine='vectorized',
+                          executor='process', max_workers=None, replicate_callback=None, seed=None):
+    config = resolve_config(config)
+    tolerances = dict(tolerance) if isinstance(tolerance, dict) else dict.fromkeys(targets, tolerance)
+    accumulator = EnsembleAccumulator(config)
+    history = []
+    pool_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+    with pool_class(max_workers=max_workers) as pool:
+        while True:
+            batch = min(batch_size, max_simulations - accumulator.num_simulations)
+            run_simulations_in_parallel(batch, engine=engine, executor=executor, max_workers=max_workers,
+                                        replicate_callback=replicate_callback, config=config,
+                                        accumulator=accumulator, first_simulation=accumulator.num_simulations,
+                                        pool=pool, seed=seed)
+            precision = {target: precision_of(accumulator, target, z, relative) for target in tolerances}
+            history.append((accumulator.num_simulations, precision))
+            reached = all(precision[target] <= tolerances[target] for target in tolerances)
+            if accumulator.num_simulations >= min_simulations and reached:
+                stopping_rule = 'tolerance'
+                break
+            if accumulator.num_simulations >= max_simulations:
+                stopping_rule = 'budget'
+                break
+
+    accumulator.adaptive_report = {
+        'stopping_rule': stopping_rule, 'num_simulations': accumulator.num_simulations, 'tolerances': tolerances,
+        'relative': relative, 'z': z, 'batch_size': batch_size, 'max_simulations': max_simulations,
+        'precision': precision, 'history': history,
+    }
+    return accumulator
+
+
+def print_adaptive_report(report):
+    kind = 'relative' if report['relative'] else 'absolute'
+    if report['stopping_rule'] == 'tolerance':
+        print(f"Stopped after {report['num_simulations']} simulations: every target reached its {kind} tolerance")
+    else:
+        print(f"Stopped after {report['num_simulations']} simulations: the budget of {report['max_simulations']} "
+              f"simulations ran out before every target reached its {kind} tolerance")
+    print("{:<25} {:>24} {:>12} {:>8}".format("Target", f"CI half-width (z={report['z']})", "Tolerance", "Met"))
+    for target, half_width in report['precision'].items():
+        tolerance = report['tolerances'][target]
+        print("{:<25} {:>24.6g} {:>12.6g} {:>8}".format(target, half_width, tolerance,
+                                                        'yes' if half_width <= tolerance else 'no'))
+
+
+# Run an ensemble of num_simulations replicates with the given configuration and return its EnsembleAccumulator.
+# With an output_directory the per-simulation average viral loads and the ensemble averages are written to the
+# result store in its Simulation_stat_analysis_data and Viral_Load_Data subdirectories; without one nothing is
+# written to disk. seed, checkpoint_path and resume are passed on to run_simulations_in_parallel. A run that resumes
+# from a checkpoint keeps the per-simulation rows that are already in the result store, as long as they have the
+# shape of this run; every other run starts them afresh.
+def run_ensemble(config=None, num_simulations=1000, engine='vectorized', executor='process', max_workers=None,
+                 output_directory=None, export_csv=False, checkpoint_path=None, resume=False, seed=None):
+    config = resolve_config(config)
+    if output_directory is None:
+        return run_simulations_in_parallel(num_simulations, engine=engine, executor=executor,
+                                           max_workers=max_workers, config=config, checkpoint_path=checkpoint_path,
+                                           resume=resume, seed=seed)
+
+    run_metadata = {'num_simulations': num_simulations, 'num_agents': config.num_agents,
+                    'time_steps': config.time_steps, 'engine': engine, 'age_groups': config.age_groups}
+
+    # Create a directory to store age group-specific data
+    viral_load_data_dir = os.path.join(output_directory, "Simulation_stat_analysis_data")
+    # The average viral loads of each simulation are written to preallocated arrays in the result store,
+    # one row per simulation in the order of the simulation numbers
+    resumed = resume and checkpoint_path is not None and find_checkpoint(checkpoint_path)[0] is not None
+    shape = (num_simulations, config.time_steps)
+
+    def simulation_averages(name, metadata):
+        if resumed and name in VL_result_store.list_results(viral_load_data_dir):
+            stored = VL_result_store.load_result(viral_load_data_dir, name, mmap_mode='r+')
+            if stored.shape == shape:
+                return stored
+            del stored
+        return VL_result_store.create_result(viral_load_data_dir, name, shape, metadata=metadata)
+    overall_avg_loads = simulation_averages('overall_avg_viral_load', run_metadata)
+    avg_loads_by_age = [simulation_averages(f'overall_avg_viral_load_age_{age_group}',
+                                            dict(run_metadata, age_group=age_group))
+                        for age_group in config.age_groups]
+
+    def write_simulation_averages(result):
+        row = result['simulation_number']
+        overall_avg_loads[row] = result['avg_viral_loads']
+        for age_group_index, age_group_data in enumerate(avg_loads_by_age):
+            age_group_data[row] = result['avg_viral_loads_by_age'][age_group_index]
+
+    ensemble = run_simulations_in_parallel(num_simulations, engine=engine, executor=executor, max_workers=max_workers,
+                                           replicate_callback=write_simulation_averages, config=config,
+                                           checkpoint_path=checkpoint_path, resume=resume, seed=seed)
+    overall_avg_loads.flush()
+    for age_group_data in avg_loads_by_age:
+        age_group_data.flush()
+
+    # Create a directory to store overall viral load data
+    ovrall_viral_load_dir = os.path.join(output_directory, "Viral_Load_Data")
+    # Save the average viral load data over all simulations to the result store
+    VL_result_store.save_result(ovrall_viral_load_dir, 'overall_viral_load', ensemble.viral_load_data.mean,
+                                metadata=dict(run_metadata, steps=ensemble.viral_load_data_steps.tolist()))
+
+    # Average viral load data by age and time for all simulations
+    for age_group_index, age_group in enumerate(config.age_groups):
+        transposed_data = ensemble.avg_viral_load_data_by_age_and_time(age_group_index)
+        if len(transposed_data) == 0:
+            continue  # Age group not recorded
+        # Save the data of each age group to the result store
+        VL_result_store.save_result(ovrall_viral_load_dir, f'viral_load_data_by_age_and_time_{age_group}',
+                                    transposed_data, metadata=dict(run_metadata, age_group=age_group,
+                                                  steps=ensemble.viral_load_data_steps.tolist()))
+
+    if export_csv:
+        VL_result_store.export_all_csv(ovrall_viral_load_dir)
+        VL_result_store.export_all_csv(viral_load_data_dir, fmt='%.17g')
+    return ensemble
+
+
+# Days exposed, days infected and age of every agent of the last finished simulation of an ensemble
+def print_agent_information(ensemble):
+    last_simulation = ensemble.last_result
+    print("\nAgent Information:")
+    print("{:<10} {:<15} {:<15} {:<5}".format("Agent ID", "Days Exposed", "Days Infected", "Age"))
+    average_infected = 0
+    agents_not_infected = 0
+    for i, (days_exposed, days_infected, age) in enumerate(zip(last_simulation['days_exposed'],
+                                                               last_simulation['days_infected'],
+                                                               last_simulation['ages'])):
+        print("{:<10} {:<15} {:<15} {:<5}".format(i + 1, days_exposed, days_infected, age))
+        average_infected += days_infected
+        if days_infected == 0:
+                agents_not_infected += 1
+    print("average days infected", average_infected/(500-agents_not_infected))
+
+
+# Ensemble means of the infection kinetics of each age group
+def print_kinetics_summary(ensemble):
+    means = ensemble.kinetics_by_age()
+    print("\nInfection kinetics by age group (means over all infections):")
+    print("{:<10} {:>10}".format("Age group", "Infections")
+          + "".join(f" {field:>15}" for field in kinetics_summary_fields))
+    for age_group, infections, row in zip(ensemble.config.age_groups, ensemble.kinetics_counts, means):
+        print("{:<10} {:>10}".format(age_group, infections) + "".join(f" {value:>15.4f}" for value in row))
+
+
+# Plot the ensemble averages into the ABM_VL_Plotting subdirectory of output_directory. matplotlib is only
+# imported here, so importing this module or running simulations in worker processes does not load it.
+def plot(ensemble, output_directory=primary_directory, show=True):
+    import matplotlib.pyplot as plt
+    config = ensemble.config
+    age_groups = config.age_groups
+    time_steps = config.time_steps
+
+    # Overall average viral load at each time step across all simulations, also by age group
+    overall_avg_viral_loads = ensemble.avg_viral_loads.mean
+    overall_avg_viral_loads_by_age = ensemble.avg_viral_loads_by_age.mean
+
+    # Average state dynamics by age
+    avg_state_dynamics_by_age = {age_group: ensemble.state_dynamics_by_age.mean[age_group_index]
+                                 for age_group_index, age_group in enumerate(age_groups)}
+
+    avg_viral_load_profiles_by_age = ensemble.avg_viral_load_profiles_by_age()
+
+    avg_state_counts = ensemble.state_counts.mean
+    # Extract individual state counts for plotting
+    s_counts = avg_state_counts[:, 0]
+    e_counts = avg_state_counts[:, 1]
+    i_counts = avg_state_counts[:, 2]
+    r_counts = avg_state_counts[:, 3]
+    d_counts = avg_state_counts[:, 4]
 
     # Create a directory to store age group state dynamics plots
-    plotting_dir = os.path.join(primary_directory, "ABM_VL_Plotting")
-    if not os.path.exists(plotting_dir):
-        os.mkdir(plotting_dir)
+    plotting_dir = os.path.join(output_directory, "ABM_VL_Plotting")
+    os.makedirs(plotting_dir, exist_ok=True)
 
     # Plot SEIR dynamics for each state of agents over time
     print(e_counts[0])
@@ -531,7 +2177,8 @@ def plotting_function():
     plt.legend()
     plt.grid(True)
     plt.savefig(os.path.join(plotting_dir, f'SEIR population state dynamics.png'), format='png')
-    plt.show()
+    if show:
+        plt.show()
 
     # Collect time total steps in a vector
     step_count = []
@@ -632,7 +2279,8 @@ def plotting_function():
     plt.legend()
     plt.grid(True)
     plt.savefig(os.path.join(plotting_dir, f'Average Viral Load Profiles for All Age Groups.pdf'),format='pdf')
-    plt.show()
+    if show:
+        plt.show()
 
     # # Plot the ratio of infected over exposed
     # plt.figure(figsize=(10, 8))
@@ -646,5 +2294,27 @@ def plotting_function():
     # plt.savefig(os.path.join(plotting_dir, 'Infected_over_Exposed_Ratio.eps'),format='eps')
     # plt.show()
 
-plotting_function()
 
+# Processes started by ProcessPoolExecutor may import this module, so the script only runs as __main__
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the ABM ensemble and plot its results.')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue a killed run from its last checkpoint instead of starting a new one')
+    arguments = parser.parse_args()
+    start_time_script = time.time()
+
+    # The run is checkpointed; a killed run picks up from its last checkpoint when started again with --resume
+    ensemble = run_ensemble(SimulationConfig(profile=True), num_simulations=1000, engine='vectorized',
+                            output_directory=primary_directory,
+                            checkpoint_path=os.path.join(primary_directory, 'Checkpoint'), resume=arguments.resume)
+
+    print(ensemble.phase_profile.summary_table())
+    # Calculate the total time taken for the entire script
+    end_time_script = time.time()
+    total_time_script = end_time_script - start_time_script
+    print(f"Total time taken for the entire script: {total_time_script} seconds")
+
+    print_agent_information(ensemble)
+    print_kinetics_summary(ensemble)
+    plot(ensemble)
@@ -15,6 +15,11 @@ thresh1 = 0.05
 thresh2 = 0.9
 thresh3 = 0.2
 
+# Transmission rule: 'pairwise' draws one random number per infected neighbour of every susceptible agent,
+# 'aggregated' counts the infected once per step and draws each susceptible agent's number of successful
+# contacts from the equivalent binomial distribution, so a step is O(N) instead of O(N^2)
+transmission = 'aggregated'
+
 # Define agent class
 class Agent:
     def __init__(self, state, viralload):
@@ -23,18 +28,25 @@ class Agent:
         self.viralload = viralload
         self.immune_days = 0
 
-    def update_state(self, neighbors):
+    def update_state(self, neighbors=(), exposure=0.0, uniform=random.random):
+        # exposure is the viral load received from all contacts this step when it is sampled in aggregate, and
+        # uniform returns the next uniform(0, 1) draw (random.random unless simulate() passes its own)
         if self.state == 'S':
             self.days_in_compartment += 1
             for neighbor in neighbors:
-                if neighbor.state == 'I' and random.random() < infection_rate:
-                    self.viralload += random.random() / 3
+                if neighbor.state == 'I' and uniform() < infection_rate:
+                    self.viralload += uniform() / 3
                     if self.viralload > thresh1:
                         self.state = 'E'
                         self.days_in_compartment = 0
+            if exposure > 0:
+                self.viralload += exposure
+                if self.viralload > thresh1:
+                    self.state = 'E'
+                    self.days_in_compartment = 0
         elif self.state == 'E':
             self.days_in_compartment += 1
-            self.viralload += random.random() / 3
+            self.viralload += uniform() / 3
             if self.days_in_compartment < latentperiod and self.viralload > thresh2:
                 self.state = 'I'
                 self.days_in_compartment = 0
@@ -45,7 +57,7 @@ class Agent:
 
         elif self.state == 'I':
             self.days_in_compartment += 1
-            self.viralload -= random.random() / 3
+            self.viralload -= uniform() / 3
             self.viralload = max(self.viralload, 0)
             if self.viralload <= thresh3:
                 self.state = 'R'
@@ -66,8 +78,28 @@ class Agent:
         return self.state
 
 
-# Define simulation function
-def simulate():
+# Viral load received by each susceptible agent in one step of the aggregated transmission rule. Agents are updated
+# in list order, so agent i sees the infected state after this step's update for the agents before it and before
+# the update for the agents after it. Susceptible agents never become infected within a step, which is why these
+# counts only need the states before and after the update of the other agents. Each of the n infected neighbours
+# transmits with probability infection_rate, so the number of successful contacts is Binomial(n, infection_rate)
+# and each success adds an independent uniform(0, 1) / 3, exactly as in the pairwise loop.
+def susceptible_exposures(infected_before, infected_after, susceptible, rng):
+    infected_before_agent = np.cumsum(infected_after) - infected_after
+    infected_after_agent = infected_before.sum() - np.cumsum(infected_before)
+    num_infected_neighbors = (infected_before_agent + infected_after_agent)[susceptible]
+    successful_contacts = rng.binomial(num_infected_neighbors, infection_rate)
+    contact_owner = np.repeat(np.arange(len(susceptible)), successful_contacts)
+    return np.bincount(contact_owner, weights=rng.random(len(contact_owner)) / 3, minlength=len(susceptible))
+
+
+# Define simulation function. Every random number comes from rng, a NumPy Generator, so a seeded rng makes the
+# run reproducible: the binomial contacts are drawn from it directly, and the per-agent draws from a random.Random
+# seeded from it, which is much faster than calling the Generator once per draw.
+def simulate(rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    uniform = random.Random(int(rng.integers(2 ** 63))).random
     # Initialize agents
     agents = []
     for i in range(num_agents):
@@ -85,9 +117,21 @@ def simulate():
     viral_load_data = [[] for _ in range(num_agents)]
     for t in range(time_steps):
         # Update agent states
-        for agent in agents:
-            neighbors = [neighbor for neighbor in agents if neighbor != agent]
-            agent.update_state(neighbors)
+        if transmission == 'aggregated':
+            # Agents that are not susceptible do not depend on their neighbours, so they are updated first
+            infected_before = np.array([agent.state == 'I' for agent in agents])
+            susceptible = np.array([i for i, agent in enumerate(agents) if agent.state == 'S'], dtype=np.int64)
+            for agent in agents:
+                if agent.state != 'S':
+                    agent.update_state(uniform=uniform)
+            infected_after = np.array([agent.state == 'I' for agent in agents])
+            exposures = susceptible_exposures(infected_before, infected_after, susceptible, rng)
+            for i, exposure in zip(susceptible, exposures):
+                agents[i].update_state(exposure=exposure, uniform=uniform)
+        else:
+            for agent in agents:
+                neighbors = [neighbor for neighbor in agents if neighbor != agent]
+                agent.update_state(neighbors, uniform=uniform)
 
 
         # Record state counts
@@ -109,23 +153,24 @@ def simulate():
     return state_counts
 
 
-# Run simulation and plot results
-state_counts = simulate()
-state_counts = np.array(state_counts)
-
-s_counts = state_counts[:, 0]
-e_counts = state_counts[:, 1]
-i_counts = state_counts[:, 2]
-r_counts = state_counts[:, 3]
-
-## Plot SEIR dynamics for each state of agents over time
-plt.figure(figsize=(10, 8))
-plt.plot(s_counts, label='Susceptible')
-plt.plot(e_counts, label='Exposed')
-plt.plot(i_counts, label='Infected')
-plt.plot(r_counts, label='Recovered')
-plt.xlabel('Time steps')
-plt.ylabel('Number of agents')
-plt.title('Agent-based SEIR model simulation')
-plt.legend()
-plt.show()
+# Run simulation and plot results when executed as a script, so that simulate() can be imported
+if __name__ == "__main__":
+    state_counts = simulate()
+    state_counts = np.array(state_counts)
+
+    s_counts = state_counts[:, 0]
+    e_counts = state_counts[:, 1]
+    i_counts = state_counts[:, 2]
+    r_counts = state_counts[:, 3]
+
+    ## Plot SEIR dynamics for each state of agents over time
+    plt.figure(figsize=(10, 8))
+    plt.plot(s_counts, label='Susceptible')
+    plt.plot(e_counts, label='Exposed')
+    plt.plot(i_counts, label='Infected')
+    plt.plot(r_counts, label='Recovered')
+    plt.xlabel('Time steps')
+    plt.ylabel('Number of agents')
+    plt.title('Agent-based SEIR model simulation')
+    plt.legend()
+    plt.show()
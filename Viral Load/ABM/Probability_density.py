@@ -1,90 +1,117 @@
 import numpy as np
-import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Non-interactive backend, plots are only saved to files
 import matplotlib.pyplot as plt
 import os
+from concurrent.futures import ProcessPoolExecutor
+import VL_result_store
 
-# Specify the directory containing the Excel files
+# Specify the directory containing the stored results
 data_directory = 'Viral_Load_Data'
 
-# Create a list of file names in the directory
-file_list = os.listdir(data_directory)
-
 # Create a directory for save the plots
 output_directory = 'VL Probability Density Plots'
-os.makedirs(output_directory, exist_ok=True)
-
-# Iterate through each file in the directory
-for file_name in file_list:
-    if file_name.endswith('.csv'):
-        # Load the viral load data from the Excel file
-        data = pd.read_csv(os.path.join(data_directory, file_name))
-
-        # Prepare data for plotting
-        viral_loads = np.round(data.values * 10)
-        time_steps = np.arange(viral_loads.shape[1])
-
-        # Create a 3D surface plot
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection='3d')
-
-        # Define the number of bins for the viral load histogram
-        num_bins = 10
-
-        # Compute the minimum rounded viral load value divided by 10
-        min_viral_load = np.min(viral_loads) / 10
-
-        # Create arrays to store the bin edges and heights for each time step
-        bin_edges = np.linspace(0, np.max(viral_loads), num_bins + 1)
-        bin_heights = np.zeros((num_bins, len(time_steps)))
-
-        # Iterate over each time step
-        for i, time_step in enumerate(time_steps):
-            # Compute the histogram for the current time step
-            hist, _ = np.histogram(viral_loads[:, i], bins=bin_edges)
-
-            # Store the bin heights
-            bin_heights[:, i] = hist / len(viral_loads)  # Compute normalized probability density
-
-        # Create a meshgrid for the bin edges and time steps
-        X, Y = np.meshgrid(bin_edges[:-1], time_steps)
-        Z = bin_heights.T
-
-        # Create the surface plot
-        surf = ax.plot_surface(X, Y, Z, cmap='viridis', edgecolor='none')
-
-        # Set the labels and title
-        ax.set_xlabel('Viral Load')
-        ax.set_ylabel('Time Steps')
-        ax.set_zlabel('Probability Density')
-        ax.set_title('3D Probability Distribution of Viral Load')
-
-        # Add a colorbar
-        # fig.colorbar(surf, ax=ax, shrink=0.5, aspect=10, pad=0.15)
-        # Show the plot
-        # plt.show()
-
-        # Create a 2D plot with colorbar
-        fig2 = plt.figure()
-        ax2 = fig2.add_subplot(111)
-        im = ax2.imshow(Z, cmap='viridis', aspect='auto', extent=[0, 1, time_steps[1], time_steps[0]])
-        fig2.colorbar(im, ax=ax2)
-
-        # Set the labels and title for the 2D plot
-        ax2.set_xlabel('Viral Load')
-        ax2.set_ylabel('Time Steps')
-        ax2.set_title('2D Probability Distribution of Viral Load')
-        # Reverse the time steps for the 2D plot
-        ax2.invert_yaxis()
-
-        # Save the plots to the output directory & Modify the file name as needed
-        plot_file_name = f"{file_name.split('.')[0]}_plot.png"
-        plot_path = os.path.join(output_directory, plot_file_name)
-
-        # Save the 3D plot
-        fig.savefig(plot_path.replace('.png', '_3D.png'))
-        plt.close(fig)
-
-        # Save the 2D plot
-        fig2.savefig(plot_path.replace('.png', '_2D.png'))
-        plt.close(fig2)
 
+# Define the number of bins for the viral load histogram
+num_bins = 10
+
+
+def density_matrix(viral_loads, bin_edges):
+    # Probability density of viral load for every time step at once, shape (time steps, bins). Each load gets its
+    # bin index with the same rule as np.histogram (bins closed on the left, the last bin also on the right), and
+    # one bincount over the combined (time step, bin) codes counts them all.
+    num_agents, num_time_steps = viral_loads.shape
+    num_bins = len(bin_edges) - 1
+    bin_index = np.clip(np.searchsorted(bin_edges, viral_loads, side='right') - 1, 0, num_bins - 1)
+    codes = np.arange(num_time_steps) * num_bins + bin_index
+    counts = np.bincount(codes.ravel(), minlength=num_time_steps * num_bins).reshape(num_time_steps, num_bins)
+    return counts / num_agents  # Compute normalized probability density
+
+
+def compute_density(result_name):
+    # Load the viral load data from the result store
+    data = VL_result_store.load_result(data_directory, result_name)
+
+    # Prepare data for plotting
+    viral_loads = np.round(data * 10)
+
+    # Create the bin edges and the heights for each time step
+    bin_edges = np.linspace(0, np.max(viral_loads), num_bins + 1)
+    Z = density_matrix(viral_loads, bin_edges)
+
+    # Save the density so the plots can be re-rendered without recomputing it
+    VL_result_store.save_result(output_directory, f'{result_name}_density', Z,
+                                metadata={'source': result_name, 'bin_edges': bin_edges.tolist()})
+    return Z, bin_edges
+
+
+def plot_density(result_name, Z, bin_edges):
+    time_steps = np.arange(Z.shape[0])
+
+    # Create a 3D surface plot
+    fig = plt.figure()
+    ax = fig.add_subplot(111, projection='3d')
+
+    # Create a meshgrid for the bin edges and time steps
+    X, Y = np.meshgrid(bin_edges[:-1], time_steps)
+
+    # Create the surface plot
+    surf = ax.plot_surface(X, Y, Z, cmap='viridis', edgecolor='none')
+
+    # Set the labels and title
+    ax.set_xlabel('Viral Load')
+    ax.set_ylabel('Time Steps')
+    ax.set_zlabel('Probability Density')
+    ax.set_title('3D Probability Distribution of Viral Load')
+
+    # Add a colorbar
+    # fig.colorbar(surf, ax=ax, shrink=0.5, aspect=10, pad=0.15)
+
+    # Create a 2D plot with colorbar
+    fig2 = plt.figure()
+    ax2 = fig2.add_subplot(111)
+    im = ax2.imshow(Z, cmap='viridis', aspect='auto', extent=[0, 1, time_steps[1], time_steps[0]])
+    fig2.colorbar(im, ax=ax2)
+
+    # Set the labels and title for the 2D plot
+    ax2.set_xlabel('Viral Load')
+    ax2.set_ylabel('Time Steps')
+    ax2.set_title('2D Probability Distribution of Viral Load')
+    # Reverse the time steps for the 2D plot
+    ax2.invert_yaxis()
+
+    # Save the plots to the output directory & Modify the file name as needed
+    plot_file_name = f"{result_name}_plot.png"
+    plot_path = os.path.join(output_directory, plot_file_name)
+
+    # Save the 3D plot
+    fig.savefig(plot_path.replace('.png', '_3D.png'))
+    plt.close(fig)
+
+    # Save the 2D plot
+    fig2.savefig(plot_path.replace('.png', '_2D.png'))
+    plt.close(fig2)
+
+
+def process_result(result_name):
+    Z, bin_edges = compute_density(result_name)
+    plot_density(result_name, Z, bin_edges)
+    return result_name
+
+
+def replot_density(result_name):
+    # Render the plots again from a saved density matrix
+    Z = VL_result_store.load_result(output_directory, f'{result_name}_density', mmap_mode=None)
+    metadata = VL_result_store.load_metadata(output_directory, f'{result_name}_density')['metadata']
+    bin_edges = np.array(metadata['bin_edges'])
+    plot_density(result_name, Z, bin_edges)
+
+
+if __name__ == '__main__':
+    os.makedirs(output_directory, exist_ok=True)
+
+    # Process each result in the directory in its own worker process
+    result_list = VL_result_store.list_results(data_directory)
+    with ProcessPoolExecutor() as executor:
+        for result_name in executor.map(process_result, result_list):
+            print(f"Saved probability density plots for {result_name}")
@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import ABM_SEIR_Viral_Load as abm
+import ABM_SEIR_Viral_Load_Basic as basic
+
+# Benchmark suite for the ABM. Every case is timed over a few repeats and then run once more under tracemalloc
+# for its peak memory. Results are written as JSON, and can be checked against a stored baseline so that a
+# slowdown or a memory increase shows up before a dependency upgrade or a model change is merged.
+#
+#   python VL_benchmark.py --quick --save-baseline benchmark_baseline.json
+#   python VL_benchmark.py --quick --baseline benchmark_baseline.json
+
+# Scaling grids, each one varied from the default configuration with the other parameters held fixed
+agent_counts = [250, 500, 1000, 2000]
+time_step_counts = [30, 60, 120]
+contact_rates = [0.1, 0.2, 0.4]
+simulation_counts = [8, 32, 128]
+engines = ['agent', 'vectorized']
+# Batch engines only run whole ensembles
+batch_engines = ['batched']
+# ABM_SEIR_Viral_Load_Basic.simulate with its default aggregated transmission is O(N) per step and runs up to 10^5
+# agents; with transmission='pairwise' it compares every pair of agents each step, so that grid is much smaller
+basic_agent_counts = [1000, 10000, 100000]
+basic_pairwise_agent_counts = [50, 100, 200]
+basic_time_steps = 20
+
+repeats = 3
+seed = 12345
+
+# Allowed slowdown and memory growth against the baseline before a case counts as a regression
+time_tolerance = 0.25
+memory_tolerance = 0.25
+
+
+def measure(function, repeats=repeats):
+    # Best and median wall time over the repeats, then the peak traced memory of one more run
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': float(np.median(timings)), 'best_seconds': min(timings), 'repeats': repeats,
+            'peak_memory_bytes': peak_memory}
+
+
+def benchmark_replicate(engine, config, repeats=repeats):
+    # Cost of one replicate of the given engine, also per time step
+    def run():
+        abm.simulation_engines[engine](0, rng=np.random.default_rng(seed), compact=True, config=config)
+    record = measure(run, repeats)
+    record['per_replicate_seconds'] = record['seconds']
+    record['per_step_seconds'] = record['seconds'] / config.time_steps
+    return record
+
+
+def benchmark_ensemble(engine, num_simulations, config, executor='process', repeats=repeats):
+    # Cost of a whole ensemble, including pool start-up and accumulation. Peak memory is that of this process,
+    # i.e. the accumulator and the results in flight, not of the worker processes.
+    def run():
+        abm.run_simulations_in_parallel(num_simulations, engine=engine, executor=executor, config=config)
+    record = measure(run, repeats)
+    record['per_replicate_seconds'] = record['seconds'] / num_simulations
+    record['per_step_seconds'] = record['per_replicate_seconds'] / config.time_steps
+    return record
+
+
+def benchmark_population(config, repeats=repeats):
+    # Start-up cost of one replicate: building the initial population with its bulk draws
+    record = measure(lambda: abm.Population(config, np.random.default_rng(seed)), repeats)
+    record['per_replicate_seconds'] = record['seconds']
+    record['per_step_seconds'] = record['seconds'] / config.time_steps
+    return record
+
+
+def benchmark_basic(num_agents, time_steps, transmission='aggregated', repeats=repeats):
+    # ABM_SEIR_Viral_Load_Basic reads its parameters from module globals and writes viral_load.csv to the working
+    # directory, so the parameters are swapped in for the run and the file goes to a temporary directory
+    saved_parameters = basic.num_agents, basic.time_steps, basic.transmission
+    working_directory = os.getcwd()
+    basic.num_agents, basic.time_steps, basic.transmission = num_agents, time_steps, transmission
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            record = measure(lambda: basic.simulate(np.random.default_rng(seed)), repeats)
+    finally:
+        os.chdir(working_directory)
+        basic.num_agents, basic.time_steps, basic.transmission = saved_parameters
+    record['per_replicate_seconds'] = record['seconds']
+    record['per_step_seconds'] = record['seconds'] / time_steps
+    return record
+
+
+def benchmark_cases(quick=False):
+    # (name, parameters, function returning the measurement) for every case of the suite
+    grid = lambda values: values[:2] if quick else values
+    default = abm.SimulationConfig(verbose=False)
+    cases = []
+    for engine in engines:
+        for num_agents in grid(agent_counts):
+            cases.append((f'{engine}/num_agents={num_agents}', {'engine': engine, 'num_agents': num_agents},
+                          lambda engine=engine, config=default.replace(num_agents=num_agents):
+                          benchmark_replicate(engine, config)))
+        for time_steps in grid(time_step_counts):
+            cases.append((f'{engine}/time_steps={time_steps}', {'engine': engine, 'time_steps': time_steps},
+                          lambda engine=engine, config=default.replace(time_steps=time_steps):
+                          benchmark_replicate(engine, config)))
+        for contacts_per_agent in grid(contact_rates):
+            cases.append((f'{engine}/contacts_per_agent={contacts_per_agent}',
+                          {'engine': engine, 'contacts_per_agent': contacts_per_agent},
+                          lambda engine=engine, config=default.replace(contacts_per_agent=contacts_per_agent):
+                          benchmark_replicate(engine, config)))
+        for num_simulations in grid(simulation_counts):
+            cases.append((f'{engine}/num_simulations={num_simulations}',
+                          {'engine': engine, 'num_simulations': num_simulations, 'executor': 'process'},
+                          lambda engine=engine, num_simulations=num_simulations:
+                          benchmark_ensemble(engine, num_simulations, default, repeats=1)))
+    for engine in batch_engines:
+        for num_simulations in grid(simulation_counts):
+            cases.append((f'{engine}/num_simulations={num_simulations}',
+                          {'engine': engine, 'num_simulations': num_simulations, 'executor': 'process'},
+                          lambda engine=engine, num_simulations=num_simulations:
+                          benchmark_ensemble(engine, num_simulations, default, repeats=1)))
+    for num_agents in grid(agent_counts):
+        cases.append((f'population/num_agents={num_agents}', {'engine': 'population', 'num_agents': num_agents},
+                      lambda config=default.replace(num_agents=num_agents): benchmark_population(config)))
+    for num_agents in grid(basic_agent_counts):
+        cases.append((f'basic/num_agents={num_agents}', {'engine': 'basic', 'num_agents': num_agents,
+                                                         'time_steps': basic_time_steps},
+                      lambda num_agents=num_agents: benchmark_basic(num_agents, basic_time_steps)))
+    for num_agents in grid(basic_pairwise_agent_counts):
+        cases.append((f'basic_pairwise/num_agents={num_agents}',
+                      {'engine': 'basic', 'transmission': 'pairwise', 'num_agents': num_agents,
+                       'time_steps': basic_time_steps},
+                      lambda num_agents=num_agents: benchmark_basic(num_agents, basic_time_steps, 'pairwise')))
+    return cases
+
+
+def run_benchmarks(quick=False, name_filter=None):
+    results = []
+    for name, parameters, function in benchmark_cases(quick):
+        if name_filter and name_filter not in name:
+            continue
+        record = dict(name=name, parameters=parameters, **function())
+        print("{:<45} {:>10.4f} s {:>12.6f} s/step {:>10.1f} MiB".format(
+            name, record['seconds'], record['per_step_seconds'], record['peak_memory_bytes'] / 2 ** 20))
+        results.append(record)
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def save_results(path, results):
+    with open(path, 'w') as file:
+        json.dump({'environment': environment(), 'results': results}, file, indent=2)
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_to_baseline(results, baseline, time_tolerance=time_tolerance, memory_tolerance=memory_tolerance):
+    # Cases that got slower or use more memory than the baseline allows. Cases missing from the baseline are skipped.
+    baseline_by_name = {record['name']: record for record in baseline['results']}
+    regressions = []
+    for record in results:
+        reference = baseline_by_name.get(record['name'])
+        if reference is None:
+            continue
+        if record['seconds'] > reference['seconds'] * (1 + time_tolerance):
+            regressions.append((record['name'], 'seconds', reference['seconds'], record['seconds']))
+        if record['peak_memory_bytes'] > reference['peak_memory_bytes'] * (1 + memory_tolerance):
+            regressions.append((record['name'], 'peak_memory_bytes', reference['peak_memory_bytes'],
+                                record['peak_memory_bytes']))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ABM simulation engines.')
+    parser.add_argument('--quick', action='store_true', help='run the first two points of every scaling grid')
+    parser.add_argument('--filter', default=None, help='only run cases whose name contains this text')
+    parser.add_argument('--output', default='benchmark_results.json', help='file for the results')
+    parser.add_argument('--baseline', default=None, help='results file to check for regressions against')
+    parser.add_argument('--save-baseline', default=None, help='also write the results to this baseline file')
+    parser.add_argument('--time-tolerance', type=float, default=time_tolerance)
+    parser.add_argument('--memory-tolerance', type=float, default=memory_tolerance)
+    arguments = parser.parse_args(arguments)
+
+    results = run_benchmarks(arguments.quick, arguments.filter)
+    save_results(arguments.output, results)
+    if arguments.save_baseline:
+        save_results(arguments.save_baseline, results)
+
+    if arguments.baseline:
+        regressions = compare_to_baseline(results, load_results(arguments.baseline),
+                                          arguments.time_tolerance, arguments.memory_tolerance)
+        for name, metric, reference, value in regressions:
+            print(f"Regression in {name}: {metric} {reference:.6g} -> {value:.6g}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
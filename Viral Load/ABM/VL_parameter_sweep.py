@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import ABM_SEIR_Viral_Load as abm
+
+# Parameter sweeps over the ABM with a content-addressed result cache. Every parameter set runs as one ensemble
+# through run_simulations_in_parallel. Its EnsembleAccumulator is saved under a hash of the parameters, the number of
+# simulations, the seed, the engine and the code version. A repeated or overlapping sweep loads those results
+# instead of running them again. The cache is bounded in size, and the least recently used entries are removed first.
+#
+#   python VL_parameter_sweep.py
+
+cache_directory = 'Sweep Cache'
+max_cache_bytes = 2 * 2 ** 30
+
+
+def parameter_grid(**values):
+    # Every combination of the given parameter values, e.g. parameter_grid(thresh3=[0.8, 1.0], immune_period=[60, 90])
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    # Hash of the model source with its line endings normalized, so any change to the model gets new cache entries
+    with open(abm.__file__) as file:
+        return hashlib.sha256(file.read().encode()).hexdigest()
+
+
+def result_key(config, num_simulations, seed, engine):
+    # Parameters that only change what is printed or profiled are not part of the key
+    key = {'parameters': config.result_hash(), 'num_simulations': num_simulations, 'seed': seed,
+           'engine': engine, 'code_version': code_version()}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def cache_entries(directory=cache_directory):
+    # (last used time, size in bytes, path) of every complete entry of the cache, least recently used first
+    if not os.path.isdir(directory):
+        return []
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if '.partial-' in name or not os.path.exists(os.path.join(path, 'accumulator.json')):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, path))
+    return sorted(entries)
+
+
+def cache_size(directory=cache_directory):
+    return sum(size for _, size, _ in cache_entries(directory))
+
+
+def evict(directory=cache_directory, max_bytes=max_cache_bytes, keep=()):
+    # Remove the least recently used entries until the cache fits in max_bytes. Entries in keep are not removed.
+    entries = cache_entries(directory)
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if os.path.basename(path) in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed.append(os.path.basename(path))
+    return removed
+
+
+def clear_cache(directory=cache_directory):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def load_cached(key, config, directory=cache_directory):
+    # The cached accumulator of key, or None. Loading marks the entry as recently used.
+    path = os.path.join(directory, key)
+    if not os.path.exists(os.path.join(path, 'accumulator.json')):
+        return None
+    os.utime(path)
+    return abm.EnsembleAccumulator(config).load(path)
+
+
+def store(key, accumulator, metadata=None, directory=cache_directory):
+    # Written to a temporary directory and then renamed, so an interrupted run never leaves a partial entry behind
+    path = os.path.join(directory, key)
+    temporary_path = f'{path}.partial-{os.getpid()}'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    accumulator.save(temporary_path, metadata)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary_path, path)
+
+
+# Run every parameter set, a dict of SimulationConfig parameters applied on top of config, as an ensemble of
+# num_simulations replicates and return [(parameters, accumulator), ...] in the order of parameter_sets. Cached
+# results are loaded; the rest share one pool and are stored in the cache, which is then trimmed to max_bytes.
+def run_sweep(parameter_sets, config=None, num_simulations=1000, seed=0, engine='vectorized', executor='process',
+              max_workers=None, directory=cache_directory, max_bytes=max_cache_bytes):
+    config = abm.resolve_config(config)
+    results = []
+    pool = None
+    try:
+        for parameters in parameter_sets:
+            run_config = config.replace(**parameters)
+            key = result_key(run_config, num_simulations, seed, engine)
+            start_time = time.time()
+            accumulator = load_cached(key, run_config, directory)
+            status = 'cached'
+            if accumulator is None:
+                if pool is None:
+                    pool_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+                    pool = pool_class(max_workers=max_workers)
+                accumulator = abm.run_simulations_in_parallel(num_simulations, engine=engine, executor=executor,
+                                                              max_workers=max_workers, config=run_config, pool=pool,
+                                                              seed=seed)
+                metadata = {'parameters': json.loads(json.dumps(parameters, default=abm.canonical_parameter)),
+                            'num_simulations': num_simulations, 'seed': seed, 'engine': engine,
+                            'code_version': code_version()}
+                store(key, accumulator, metadata, directory)
+                evict(directory, max_bytes, keep=[key])
+                status = 'computed'
+            print(f"{status:<9} {time.time() - start_time:8.2f} s  {key[:12]}  {parameters}")
+            results.append((parameters, accumulator))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    sweep = run_sweep(parameter_grid(thresh3=[0.8, 1.0, 1.2]), abm.SimulationConfig(verbose=False),
+                      num_simulations=200)
+    for parameters, ensemble in sweep:
+        deaths = ensemble.state_counts.mean[-1, abm.D_STATE]
+        print(f"{parameters}: peak average viral load {ensemble.avg_viral_loads.mean.max():.4f}, "
+              f"average deaths {deaths:.2f}")
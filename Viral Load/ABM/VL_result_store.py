@@ -0,0 +1,68 @@
+import os
+import json
+import time
+import numpy as np
+
+# Binary result store for the ABM outputs. Every result is one .npy file holding the array and a .json file next
+# to it with the dtype, shape and run metadata. Arrays are written in bulk and read back memory-mapped, so the
+# analysis scripts do not format or parse any text. CSV export is kept as an optional extra step.
+
+
+def _result_paths(directory, name):
+    return os.path.join(directory, f'{name}.npy'), os.path.join(directory, f'{name}.json')
+
+
+def _write_metadata(directory, name, dtype, shape, metadata):
+    _, metadata_path = _result_paths(directory, name)
+    with open(metadata_path, 'w') as file:
+        json.dump({'name': name, 'dtype': np.dtype(dtype).str, 'shape': list(shape),
+                   'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'metadata': metadata or {}}, file, indent=2)
+
+
+def save_result(directory, name, data, metadata=None):
+    # Write a whole array at once
+    os.makedirs(directory, exist_ok=True)
+    data = np.asarray(data)
+    data_path, _ = _result_paths(directory, name)
+    np.save(data_path, data)
+    _write_metadata(directory, name, data.dtype, data.shape, metadata)
+
+
+def create_result(directory, name, shape, dtype=np.float64, metadata=None):
+    # Preallocate an array on disk and return it memory-mapped for writing, e.g. one row per finished simulation
+    os.makedirs(directory, exist_ok=True)
+    data_path, _ = _result_paths(directory, name)
+    _write_metadata(directory, name, dtype, shape, metadata)
+    return np.lib.format.open_memmap(data_path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def load_result(directory, name, mmap_mode='r'):
+    # Memory-mapped, read-only view of a stored array (mmap_mode=None loads it into memory)
+    data_path, _ = _result_paths(directory, name)
+    return np.load(data_path, mmap_mode=mmap_mode)
+
+
+def load_metadata(directory, name):
+    _, metadata_path = _result_paths(directory, name)
+    with open(metadata_path) as file:
+        return json.load(file)
+
+
+def list_results(directory):
+    # Names of all results stored in a directory, in sorted order
+    if not os.path.isdir(directory):
+        return []
+    names = [os.path.splitext(file)[0] for file in os.listdir(directory) if file.endswith('.npy')]
+    return sorted(name for name in names if os.path.exists(os.path.join(directory, f'{name}.json')))
+
+
+def export_csv(directory, name, csv_path=None, fmt='%0.4f'):
+    # Write a stored one or two dimensional result as CSV, by default next to the .npy file
+    if csv_path is None:
+        csv_path = os.path.join(directory, f'{name}.csv')
+    np.savetxt(csv_path, np.atleast_2d(load_result(directory, name)), delimiter=',', fmt=fmt)
+    return csv_path
+
+
+def export_all_csv(directory, fmt='%0.4f'):
+    return [export_csv(directory, name, fmt=fmt) for name in list_results(directory)]
@@ -1,14 +1,38 @@
 import os
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from concurrent.futures import ThreadPoolExecutor
+import VL_result_store
+
+def chunked_mean_and_variance(data, block_rows=65536):
+    # Mean and variance over the rows in one streaming pass over blocks of rows, so a memory-mapped file larger
+    # than RAM only ever has one block in memory. Block results are merged with the parallel variance formula.
+    count = 0
+    mean = None
+    m2 = None
+    for start in range(0, len(data), block_rows):
+        block = np.asarray(data[start:start + block_rows], dtype=float)
+        block_count = len(block)
+        block_mean = block.mean(axis=0)
+        block_m2 = ((block - block_mean) ** 2).sum(axis=0)
+        if mean is None:
+            count, mean, m2 = block_count, block_mean, block_m2
+        else:
+            delta = block_mean - mean
+            total = count + block_count
+            mean = mean + delta * block_count / total
+            m2 = m2 + block_m2 + delta ** 2 * count * block_count / total
+            count = total
+    return count, mean, m2 / count
 
 def plot_variance_and_ci(data, age_group, save_dir=None):
-    mean = np.mean(data, axis=0)
-    variance = np.var(data, axis=0)
-    std_dev = np.std(data, axis=0)
-    ci = 1.645 * (std_dev / np.sqrt(len(data)))  # 90% confidence interval using Z-score for normal distribution
+    count, mean, variance = chunked_mean_and_variance(data)
+    return plot_mean_variance_and_ci(count, mean, variance, age_group, save_dir)
+
+def plot_mean_variance_and_ci(count, mean, variance, age_group, save_dir=None):
+    std_dev = np.sqrt(variance)
+    ci = 1.645 * (std_dev / np.sqrt(count))  # 90% confidence interval using Z-score for normal distribution
     time_steps = np.arange(len(variance))
 
     plt.plot(time_steps, mean, label='Mean')
@@ -69,22 +93,24 @@ def plot_ci_ratio(ci_data, age_group1, age_group2, save_dir=None):
     plt.close()
 
 def main():
-    directory = 'C:/Users/antho/PycharmProjects/pythonProject/Primary ABM Model Directory/Viral_Load_Data'  # Update this with the path to your directory of CSV files
-    save_directory = 'C:/Users/antho/PycharmProjects/pythonProject/Primary ABM Model Directory/ABM_VL_Plotting'  # Update this with the path where you want to save the plots
-    files = os.listdir(directory)
+    # Update this with the path to your directory of stored results
+    directory = 'C:/Users/antho/PycharmProjects/pythonProject/Primary ABM Model Directory/Viral_Load_Data'
+    # Update this with the path where you want to save the plots
+    save_directory = 'C:/Users/antho/PycharmProjects/pythonProject/Primary ABM Model Directory/ABM_VL_Plotting'
     all_ci_data = {}
 
-    for file in files:
-        if file.endswith('.csv'):
-            age_group = os.path.splitext(file)[0]
-            file_path = os.path.join(directory, file)
-            df = pd.read_csv(file_path)
+    def result_statistics(age_group):
+        # Memory-mapped array, each row represents a person and each column represents a time step
+        return chunked_mean_and_variance(VL_result_store.load_result(directory, age_group))
 
-            # Assuming each row represents a person and each column represents a time step
-            viral_load_data = df.to_numpy()
+    # Reduce all age group files concurrently, then plot them one after another
+    age_groups = VL_result_store.list_results(directory)
+    with ThreadPoolExecutor() as executor:
+        all_statistics = list(executor.map(result_statistics, age_groups))
 
-            time_steps, ci_widths = plot_variance_and_ci(viral_load_data, age_group, save_directory)
-            all_ci_data[age_group] = (time_steps, ci_widths)
+    for age_group, (count, mean, variance) in zip(age_groups, all_statistics):
+        time_steps, ci_widths = plot_mean_variance_and_ci(count, mean, variance, age_group, save_directory)
+        all_ci_data[age_group] = (time_steps, ci_widths)
 
     plot_ci_widths(all_ci_data, save_directory)
 